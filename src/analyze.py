@@ -1,20 +1,20 @@
+import argparse
 import json
 import os
 from glob import glob
 
 import napari
 import numpy as np
-import pandas as pd
 import pyi_splash
-import shapely
+import tifffile
 from magicgui import magicgui
+from modules import alignment, atlas_bundle, constants, quantification, regions
 from modules.classes import Atlas, Background, Results, SectionImage
 from modules.select_data import SelectDataWindow
 from PyQt5.QtWidgets import QApplication
 from qtpy.QtWidgets import QCheckBox, QLineEdit
 from scipy import ndimage as ndi
-from skimage import filters, img_as_ubyte, io, measure, morphology
-from skimage.transform import rescale
+from skimage import filters, img_as_ubyte, measure, morphology
 
 ATLAS_DIR = os.path.join(os.path.dirname(__file__), "brain_atlas_files")
 
@@ -22,46 +22,65 @@ ATLAS_DIR = os.path.join(os.path.dirname(__file__), "brain_atlas_files")
 global viewer, bg, atlas, section_image, section_image_paths, results_data
 
 
-def _load_atlas_data():
-    anatomical_atlas = io.imread(os.path.join(ATLAS_DIR, "anatomical_atlas.tif"))
-    rois = io.imread(os.path.join(ATLAS_DIR, "rois_atlas.tif"))
+def _open_atlas_stack(stack_path: str) -> np.ndarray:
+    # stacks are memory-mapped and read on demand, stacks that are not
+    # memory-mappable, e.g. compressed ones, are read into memory
+    try:
+        return tifffile.memmap(stack_path, mode="r")
+    except ValueError:
+        return tifffile.imread(stack_path)
 
-    with open(os.path.join(ATLAS_DIR, "roi_colors.json")) as f:
-        data = json.load(f)
-        str_roi_list = list(data.keys())
-        region_column_names = ["All_rois"] + list(str_roi_list)
-        roi_colors_dict = data
 
-    slice_centroids_dict = {}
-    df = pd.read_csv(os.path.join(ATLAS_DIR, "slice_centroids.csv"))
-    for _, row in df.iterrows():
-        slice_centroids_dict[int(row["slice"])] = (row["centroid_y"], row["centroid_x"])
+def _load_contrast_limits(atlas_dir: str, stacks: dict) -> dict:
+    # contrast limits are stored by setup_brain_atlas.py, they are only computed
+    # for atlases set up before that
+    contrast_limits = {}
+    metadata_path = os.path.join(atlas_dir, "atlas_metadata.json")
+    if os.path.isfile(metadata_path):
+        with open(metadata_path) as f:
+            contrast_limits = json.load(f).get("contrast_limits", {})
 
-    with open(os.path.join(ATLAS_DIR, "roi_shapes.json")) as f:
-        data = json.load(f)
-        roi_shapes_dict = data
+    return {
+        fname: contrast_limits.get(fname, [0, np.max(stack)])
+        for fname, stack in stacks.items()
+    }
+
+
+def _load_atlas_data(atlas_dir: str = ATLAS_DIR):
+    anatomical_atlas = _open_atlas_stack(
+        os.path.join(atlas_dir, "anatomical_atlas.tif")
+    )
+    rois = _open_atlas_stack(os.path.join(atlas_dir, "rois_atlas.tif"))
+    contrast_limits = _load_contrast_limits(
+        atlas_dir, {"anatomical_atlas.tif": anatomical_atlas, "rois_atlas.tif": rois}
+    )
+
+    bundle = atlas_bundle.load_bundle(atlas_dir)
+    region_column_names = regions.results_columns()
+    slice_centroids_dict = bundle.slice_centroids_dict()
 
     return (
         anatomical_atlas,
         rois,
+        contrast_limits,
         region_column_names,
         slice_centroids_dict,
-        roi_shapes_dict,
-        roi_colors_dict,
+        bundle,
     )
 
 
 def _select_background(data_dir: str):
-    if not os.path.isdir(os.path.join(data_dir, '..', 'tiff')):
-        slide_path = glob(os.path.join(data_dir,"..","..", "tiff", "*.tif"))[0]
-    else:
-        slide_path = glob(os.path.join(data_dir, "..","tiff", "*.tif"))[0]
-    bg.image = io.imread(slide_path)
-
-    # scalle down bg image to reduce size
-    bg.image = rescale(bg.image, 0.5, anti_aliasing=False, preserve_range=True)
+    slide_path = quantification.find_slide_path(data_dir)
+    bg.image = quantification.load_background_image(slide_path)
     bg.height, bg.width = int(bg.image.shape[0]), int(bg.image.shape[1])
     rect_y, rect_x = int(bg.height / 2) - 400, int(bg.width / 2) - 200
+    bg_rect = np.array([[rect_y, rect_x], [rect_y + 400, rect_x + 200]])
+
+    # a folder that was started before resumes with its saved background
+    background = alignment.load_background(data_dir)
+    if background is not None:
+        bg_rect = background["vertices"]
+        bg.mean = background["mean"]
 
     viewer.add_image(
         bg.image,
@@ -70,7 +89,6 @@ def _select_background(data_dir: str):
         contrast_limits=[0, np.max(bg.image)],
     )
     bg.napari_layer = viewer.add_shapes(opacity=0.4, name="background_area")
-    bg_rect = np.array([[rect_y, rect_x], [rect_y + 400, rect_x + 200]])
     bg.napari_layer.add_rectangles(
         bg_rect, edge_width=10, edge_color="red", face_color="orange"
     )
@@ -87,15 +105,8 @@ def _select_background(data_dir: str):
 
 
 def _get_background():
-    y = bg.height
-    x = bg.width
-
-    canvas_rect = np.array([[0, 0], [y - 1, x - 1]])
-    bg.napari_layer.add_rectangles(canvas_rect)  # to keep shape image layer
-    bg_labels = bg.napari_layer.to_labels()
-    bg.napari_layer.data = bg.napari_layer.data[0 : (len(bg.napari_layer.data) - 1)]
-    # mean = slide_img[bg_labels == 1].mean()
-    mean = bg.image[bg_labels == 1].mean()
+    # the background rectangle is the first shape of the layer
+    mean = quantification.background_mean(bg.image, bg.napari_layer.data[0])
     return mean
 
 
@@ -105,16 +116,24 @@ def _initialize_analysis_tool():
     bg.napari_dock.hide()
 
     atlas.napari_atlas_layer = viewer.add_image(
-        atlas.image, name="anatomical_stack", contrast_limits=[0, np.max(atlas.image)]
+        atlas.image,
+        name="anatomical_stack",
+        contrast_limits=atlas.contrast_limits["anatomical_atlas.tif"],
     )
 
     atlas.napari_roi_layer = viewer.add_image(
         atlas.rois,
         name="atlas_rois",
         colormap="turbo",
-        contrast_limits=[0, np.max(atlas.rois)],
+        contrast_limits=atlas.contrast_limits["rois_atlas.tif"],
     )
 
+    section_alignment = alignment.load_alignment(
+        os.path.dirname(section_image.path), section_image.name, draft=True
+    )
+    if section_alignment is not None:
+        _restore_alignment(section_alignment)
+
     section_image.napari_layer = viewer.add_image(
         section_image.image, name="section_image", colormap="gray_r"
     )
@@ -168,19 +187,14 @@ def _align_centroids():
     props_img = measure.regionprops(measure.label(masked_img))
     center_of_mass_image = props_img[0].centroid
 
-    image = np.roll(
-        section_image.image,
-        -int(center_of_mass_image[1] - center_of_mass_atlas[1]),
-        axis=1,
-    )
-
-    image = np.roll(
-        section_image.image,
+    # the section is rolled along both axes so its centroid matches the one of the
+    # atlas slice, the shift is saved with the alignment
+    section_image.shift = (
         -int(center_of_mass_image[0] - center_of_mass_atlas[0]),
-        axis=0,
+        -int(center_of_mass_image[1] - center_of_mass_atlas[1]),
     )
 
-    return image
+    return np.roll(section_image.image, section_image.shift, axis=(0, 1))
 
 
 def _load_selected_rois(simplification: int = 0):
@@ -196,32 +210,39 @@ def _load_selected_rois(simplification: int = 0):
         section_image.image, name="section_image", colormap="gray_r"
     )
 
-    roi_names = []
-    atlas.napari_roi_shapes_layer = viewer.add_shapes(opacity=0.4, name="rois")
-
-    shapes_layer = atlas.napari_roi_shapes_layer
-    colors_dict = atlas.roi_colors_dict
+    # the ROIs of a restored alignment are added once if its slice is still
+    # selected, adding them again resets them to the atlas polygons
+    rois = alignment.saved_rois(section_image.saved_alignment, atlas.selected_slice)
+    section_image.saved_alignment = None
+    if rois is not None:
+        _add_roi_shapes(*rois)
+        return
+
+    # simplified polygons are precomputed in the atlas bundle
+    slice_polygons = atlas.roi_shapes.slice_polygons(
+        atlas.selected_slice, simplification
+    )
 
-    for roi in atlas.roi_shapes_dict[str(atlas.selected_slice)]:
-        polygon_list_coords = atlas.roi_shapes_dict[str(atlas.selected_slice)][roi]
-        polygon_simplified = _simplify_polygons(polygon_list_coords, simplification)
+    roi_names = []
+    polygons = []
+    for roi, polygon_list_coords in slice_polygons.items():
+        roi_names.extend([roi] * len(polygon_list_coords))
+        polygons.extend(polygon_list_coords)
 
-        if len(polygon_list_coords) > 0:
-            roi_names.extend([roi] * len(polygon_list_coords))
+    _add_roi_shapes(roi_names, polygons)
 
-            rgb_values = colors_dict[roi][1][:-1]
-            opacity_value = colors_dict[roi][1][-1]
 
-            rgb_floats = []
-            for i in rgb_values:
-                rgb_floats.append(i / 255.0)
+def _add_roi_shapes(roi_names: list, polygons: list):
+    atlas.napari_roi_shapes_layer = viewer.add_shapes(opacity=0.4, name="rois")
+    shapes_layer = atlas.napari_roi_shapes_layer
 
-            shapes_layer.add_polygons(
-                np.array(polygon_simplified, dtype=object),
-                edge_width=2,
-                edge_color="red",
-                face_color=rgb_floats + [opacity_value],
-            )
+    if len(polygons) > 0:
+        shapes_layer.add_polygons(
+            polygons,
+            edge_width=2,
+            edge_color="red",
+            face_color=regions.colors(roi_names),
+        )
 
     shapes_layer.text = {
         "string": roi_names,
@@ -232,141 +253,134 @@ def _load_selected_rois(simplification: int = 0):
     }
 
 
-def _simplify_polygons(input_polygon, tolerance_value):
-    contours_s = []
-    for shape in input_polygon:
-        poly = shapely.geometry.Polygon(shape)
-        poly_s = poly.simplify(tolerance=tolerance_value)
-        contours_s.append(np.array(poly_s.boundary.coords[:]))
-    return contours_s
-
-
 def _hide_unselected_rois():
-    selected = list(atlas.napari_roi_shapes_layer.selected_data)
-    selected_names = atlas.napari_roi_shapes_layer.text.string.array[selected]
-    color_array = []
-    edge_color = []
-    iter_t = 0
-
-    for i in range(atlas.napari_roi_shapes_layer.nshapes):
-        if i in selected:
-            rgb_values = atlas.roi_colors_dict[selected_names[iter_t]][1][:-1]
-            opacity_value = atlas.roi_colors_dict[selected_names[iter_t]][1][-1]
-
-            rgb_floats = []
+    shapes_layer = atlas.napari_roi_shapes_layer
+    selected = np.zeros(shapes_layer.nshapes, dtype=bool)
+    selected[list(shapes_layer.selected_data)] = True
 
-            for i in rgb_values:
-                rgb_floats.append(i / 255.0)
+    # unselected shapes are transparent
+    face_color = regions.colors(shapes_layer.text.string.array)
+    face_color[~selected] = 0
+    edge_color = np.zeros((shapes_layer.nshapes, 4))
+    edge_color[selected] = [1.0, 0.0, 0.0, 1.0]
 
-            color_array.append(rgb_floats + [opacity_value])
-            edge_color.append([1.0, 0.0, 0.0, 1.0])
-            iter_t += 1
-        else:
-            color_array.append([0.0, 0.0, 0.0, 0.0])
-            edge_color.append([0.0, 0.0, 0.0, 0.0])
-
-    atlas.napari_roi_shapes_layer.face_color = color_array
-    atlas.napari_roi_shapes_layer.edge_color = edge_color  # transparent
+    shapes_layer.face_color = face_color
+    shapes_layer.edge_color = edge_color
 
 
 def _show_all_rois():
-    roi_names = atlas.napari_roi_shapes_layer.text.string.array
-    color_array = []
-    edge_color = []
-    for i in range(atlas.napari_roi_shapes_layer.nshapes):
-        rgb_values = atlas.roi_colors_dict[roi_names[i]][1][:-1]
-        opacity_value = atlas.roi_colors_dict[roi_names[i]][1][-1]
-
-        rgb_floats = []
-        for i in rgb_values:
-            rgb_floats.append(i / 255.0)
-
-        color_array.append(rgb_floats + [opacity_value])
-        edge_color.append([1.0, 0.0, 0.0, 1.0])
-    atlas.napari_roi_shapes_layer.face_color = color_array
-    atlas.napari_roi_shapes_layer.edge_color = edge_color
-
-
-def _get_mapped_labels(label_image: np.ndarray, names: list) -> np.ndarray:
-    unique_names = list(set(names))
-
-    mapping_dict = {}
-    for name in unique_names:
-        matching_indices = [
-            index + 1 for index, element in enumerate(names) if element == name
-        ]
+    shapes_layer = atlas.napari_roi_shapes_layer
+    edge_color = np.zeros((shapes_layer.nshapes, 4))
+    edge_color[:] = [1.0, 0.0, 0.0, 1.0]
 
-        mapping_dict[name] = matching_indices
+    shapes_layer.face_color = regions.colors(shapes_layer.text.string.array)
+    shapes_layer.edge_color = edge_color
 
-    mapped_label_image = np.copy(label_image)
 
-    for idx, name in enumerate(unique_names):
-        label_values = mapping_dict[name]
+def _analyze_roi():
+    shapes_layer = atlas.napari_roi_shapes_layer
+    roi_names = shapes_layer.text.string.array.tolist()
+    roi_polygons = shapes_layer.data
 
-        for v in label_values:
-            mapped_label_image[label_image == v] = idx + 1
+    results_dict = {
+        "image_filename": section_image.name,
+        **quantification.section_results(
+            section_image.image, roi_polygons, roi_names, bg.mean
+        ),
+    }
+    results_data.add_row(results_dict)
 
-    return unique_names, mapped_label_image
+    # the alignment is saved so the section can be quantified again by
+    # analyze_batch.py
+    _save_alignment(analyzed=True)
 
 
-def _polygons_to_roi() -> np.ndarray:
+def _save_alignment(analyzed: bool):
     shapes_layer = atlas.napari_roi_shapes_layer
+    alignment.save_alignment(
+        os.path.dirname(section_image.path),
+        section_image.name,
+        atlas_slice=atlas.selected_slice,
+        image_shift=section_image.shift,
+        roi_names=shapes_layer.text.string.array.tolist(),
+        roi_polygons=shapes_layer.data,
+        background={"vertices": bg.napari_layer.data[0], "mean": bg.mean},
+        analyzed=analyzed,
+    )
 
-    labels = shapes_layer.to_labels(labels_shape=section_image.image.shape)
-    label_names = shapes_layer.text.string.array
-
-    label_names, labels = _get_mapped_labels(labels, label_names)
-    # here add background so that the label indices match
-    label_names = ["bg"] + label_names
-
-    return label_names, labels
 
+def _restore_alignment(section_alignment: dict):
+    # the saved shift replaces the alignment of the centroids
+    section_image.shift = section_alignment["image_shift"]
+    section_image.image = np.roll(section_image.image, section_image.shift, axis=(0, 1))
 
-def _analyze_roi():
-    label_names, labels = _polygons_to_roi()
-    all_regions = labels > 0
+    if section_alignment["atlas_slice"] is None:
+        return
 
-    results_dict = {
-        "image_filename": section_image.name,
-    }
+    atlas.selected_slice = section_alignment["atlas_slice"]
+    if "atlas_rois" in viewer.layers:
+        # the saved ROIs are added by "Add ROIs / Reset"
+        viewer.dims.set_current_step(0, atlas.selected_slice)
+        section_image.saved_alignment = section_alignment
+    elif "rois" in viewer.layers:
+        viewer.layers.remove("rois")
+        _add_roi_shapes(
+            section_alignment["roi_names"], section_alignment["roi_polygons"]
+        )
 
-    # Measure and record values for combined ROIs
-    area = np.count_nonzero(all_regions)
-    mean = section_image.image[all_regions].mean()
 
-    bg_subtracted_mean_per_pixel = None
-    if mean > bg.mean:
-        bg_subtracted_mean_per_pixel = (mean - bg.mean) / area
-    else:
-        bg_subtracted_mean_per_pixel = 0
+def _open_section_image(path: str):
+    global section_image
 
-    results_dict["All_ROIs"] = bg_subtracted_mean_per_pixel
+    # the alignment of the current section is saved as a draft so it is restored
+    # when the section is opened again, the alignment of analyzed ROIs is kept
+    if "rois" in viewer.layers:
+        _save_alignment(analyzed=False)
 
-    for region_name in results_data.region_names:
-        if region_name == "All_ROIs":
-            continue
-        if region_name in label_names:
-            roi_mean = section_image.image[
-                labels == label_names.index(region_name)
-            ].mean()
+    if "section_image" in viewer.layers:
+        viewer.layers.remove("section_image")
+    section_image = SectionImage(path)
 
-            area = np.count_nonzero(labels == label_names.index(region_name))
+    section_alignment = alignment.load_alignment(
+        os.path.dirname(path), section_image.name, draft=True
+    )
+    if section_alignment is not None:
+        _restore_alignment(section_alignment)
+    elif "atlas_rois" in viewer.layers:
+        if viewer.dims.current_step[0] == 0:
+            pass
+        else:
+            section_image.image = _align_centroids()
 
-            bg_subtracted_mean_per_pixel = (
-                roi_mean - bg.mean if roi_mean > bg.mean else 0
-            ) / area
+    if results_data.image_is_analyzed(section_image.name):
+        colormap = "gray_r"
+        show_analyzed_widget.setChecked(True)
+    else:
+        colormap = "gray_r"
+        show_analyzed_widget.setChecked(False)
 
-            results_dict[region_name] = bg_subtracted_mean_per_pixel
-        else:
-            results_dict[region_name] = np.nan
+    section_image.napari_layer = viewer.add_image(
+        section_image.image, name="section_image", colormap=colormap
+    )
 
-    results_data.add_row(results_dict)
+    show_image_name_widget.setText(section_image.name)
+    if len(viewer.layers) == 3:
+        pass
+    else:
+        viewer.layers.reverse()
+        viewer.layers.selection.active = atlas.napari_roi_shapes_layer
+        atlas.napari_roi_shapes_layer.mode = "SELECT"
 
 
 @magicgui(call_button="Calculate background", result_widget=True)
 def calculate_bg_widget():
     bg.mean = 0
     bg.mean = _get_background()
+
+    # the background is saved once for all sections of the folder
+    alignment.save_background(
+        os.path.dirname(section_image.path), bg.napari_layer.data[0], bg.mean
+    )
     return bg.mean
 
 
@@ -377,9 +391,12 @@ def start_alignment():
     _initialize_analysis_tool()
 
 
-@magicgui(call_button="Add ROIs / Reset")
-def rois_widget():
-    _load_selected_rois()
+@magicgui(
+    call_button="Add ROIs / Reset",
+    simplification={"choices": atlas_bundle.SIMPLIFICATION_LEVELS},
+)
+def rois_widget(simplification: int = 0):
+    _load_selected_rois(simplification)
     for widget in [hide_widget, show_all_widget, analyze_widget]:
         widget.enabled = True
 
@@ -407,14 +424,16 @@ def atlas_view_widget():
     viewer.layers.select_all()
     viewer.layers.remove_selected()
     atlas.napari_atlas_layer = viewer.add_image(
-        atlas.image, name="anatomical_stack", contrast_limits=[0, np.max(atlas.image)]
+        atlas.image,
+        name="anatomical_stack",
+        contrast_limits=atlas.contrast_limits["anatomical_atlas.tif"],
     )
 
     atlas.napari_roi_layer = viewer.add_image(
         atlas.rois,
         name="atlas_rois",
         colormap="turbo",
-        contrast_limits=[0, np.max(atlas.rois)],
+        contrast_limits=atlas.contrast_limits["rois_atlas.tif"],
     )
 
     section_image.napari_layer = viewer.add_image(
@@ -429,105 +448,55 @@ def atlas_view_widget():
 
 @magicgui(call_button="Next image")
 def next_image_widget():
-    global section_image
     section_image_paths_index = section_image_paths.index(section_image.path)
 
     if section_image_paths_index == len(section_image_paths) - 1:
         pass
     else:
-        if "section_image" in viewer.layers:
-            viewer.layers.remove("section_image")
-        section_image_paths_index += 1
-        section_image = SectionImage(section_image_paths[section_image_paths_index])
-
-        if "atlas_rois" in viewer.layers:
-            if viewer.dims.current_step[0] == 0:
-                pass
-            else:
-                section_image.image = _align_centroids()
-
-        if results_data.image_is_analyzed(section_image.name):
-            colormap = "gray_r"
-            show_analyzed_widget.setChecked(True)
-        else:
-            colormap = "gray_r"
-            show_analyzed_widget.setChecked(False)
-
-        section_image.napari_layer = viewer.add_image(
-            section_image.image, name="section_image", colormap=colormap
-        )
-
-        show_image_name_widget.setText(section_image.name)
-        if len(viewer.layers) == 3:
-            pass
-        else:
-            viewer.layers.reverse()
-            viewer.layers.selection.active = atlas.napari_roi_shapes_layer
-            atlas.napari_roi_shapes_layer.mode = "SELECT"
+        _open_section_image(section_image_paths[section_image_paths_index + 1])
 
 
 @magicgui(call_button="Previous image")
 def previous_image_widget():
-    global section_image
     section_image_paths_index = section_image_paths.index(section_image.path)
 
     if section_image_paths_index == 0:
         pass
     else:
-        if "section_image" in viewer.layers:
-            viewer.layers.remove("section_image")
-        section_image_paths_index -= 1
-        section_image = SectionImage(section_image_paths[section_image_paths_index])
-
-        if "atlas_rois" in viewer.layers:
-            if viewer.dims.current_step[0] == 0:
-                pass
-            else:
-                section_image.image = _align_centroids()
-        if "atlas_rois" in viewer.layers:
-            if viewer.dims.current_step[0] == 0:
-                pass
-            else:
-                section_image.image = _align_centroids()
-
-        if results_data.image_is_analyzed(section_image.name):
-            colormap = "gray_r"
-            show_analyzed_widget.setChecked(True)
-        else:
-            colormap = "gray_r"
-            show_analyzed_widget.setChecked(False)
-
-        section_image.napari_layer = viewer.add_image(
-            section_image.image, name="section_image", colormap=colormap
-        )
-
-        show_image_name_widget.setText(section_image.name)
-        if len(viewer.layers) == 3:
-            pass
-        else:
-            viewer.layers.reverse()
-            viewer.layers.selection.active = atlas.napari_roi_shapes_layer
-            atlas.napari_roi_shapes_layer.mode = "SELECT"
+        _open_section_image(section_image_paths[section_image_paths_index - 1])
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--atlas",
+        type=str,
+        default=constants.DEFAULT_ATLAS,
+        help="Atlas set up with setup_brain_atlas.py",
+    )
+    args = parser.parse_args()
+    atlas_dir = constants.get_atlas_dir(ATLAS_DIR, args.atlas)
+    assert args.atlas == constants.DEFAULT_ATLAS or os.path.isfile(
+        os.path.join(atlas_dir, "atlas_metadata.json")
+    ), f"Atlas {args.atlas} is not set up, run setup_brain_atlas.py --atlas {args.atlas}"
+
     ## load and configure atlas data
     (
         anatomical_atlas,
         rois,
+        contrast_limits,
         region_column_names,
         slice_centroids_dict,
-        roi_shapes_dict,
-        roi_colors_dict,
-    ) = _load_atlas_data()
+        roi_shapes,
+    ) = _load_atlas_data(atlas_dir)
 
     atlas = Atlas(
         image=anatomical_atlas,
         rois=rois,
+        contrast_limits=contrast_limits,
         region_column_names=region_column_names,
         slice_centroids_dict=slice_centroids_dict,
-        roi_shapes_dict=roi_shapes_dict,
-        roi_colors_dict=roi_colors_dict,
+        roi_shapes=roi_shapes,
     )
 
     app = QApplication([])
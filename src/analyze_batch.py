@@ -0,0 +1,161 @@
+"""
+MODULE: Headless batch analysis
+
+Quantifies the sections of a sections folder again from the alignments saved by the
+analysis tool, without napari. The saved atlas slice shift and ROI polygons are
+applied to every section, sections are quantified in parallel and results.csv is
+updated once all of them are done. Sections that have not been analyzed in the
+analysis tool are skipped.
+
+Example:
+    python analyze_batch.py --sections-dir preprocessed/slide/animal/sections --workers 8
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+
+import numpy as np
+from skimage import io
+
+from modules import alignment, batch, quantification
+from modules.classes import Results
+
+# saved: background mean saved with the alignment
+# slide: background mean computed again from the saved rectangle on the slide
+BACKGROUND_METHODS = ("saved", "slide")
+
+
+def _analyze_section(section_path: str, section_alignment: dict, bg_mean: float):
+    image = io.imread(section_path)
+    image = np.roll(image, section_alignment["image_shift"], axis=(0, 1))
+
+    return {
+        "image_filename": os.path.basename(section_path),
+        **quantification.section_results(
+            image,
+            section_alignment["roi_polygons"],
+            section_alignment["roi_names"],
+            bg_mean,
+        ),
+    }
+
+
+def _background_means(data_dir: str, alignments: dict, background: str) -> dict:
+    if background == "saved":
+        return {k: v["background"]["mean"] for k, v in alignments.items()}
+
+    # the slide is read once, sections sharing a background rectangle share its mean
+    bg_image = quantification.load_background_image(
+        quantification.find_slide_path(data_dir)
+    )
+
+    rectangle_means = {}
+    bg_means = {}
+    for section_path, section_alignment in alignments.items():
+        vertices = np.asarray(section_alignment["background"]["vertices"])
+        key = vertices.tobytes()
+        if key not in rectangle_means:
+            rectangle_means[key] = quantification.background_mean(bg_image, vertices)
+
+        bg_means[section_path] = rectangle_means[key]
+
+    return bg_means
+
+
+def run_batch(data_dir: str, num_workers: int = None, background: str = "saved"):
+    assert os.path.isdir(data_dir), f"{data_dir} does not exist"
+    assert (
+        background in BACKGROUND_METHODS
+    ), f"Unknown background {background}, use one of {BACKGROUND_METHODS}"
+
+    alignments = {}
+    skipped = []
+    for section_path in sorted(glob(os.path.join(data_dir, "*.tif"))):
+        section_alignment = alignment.load_alignment(
+            data_dir, os.path.basename(section_path)
+        )
+        if section_alignment is None or not section_alignment["analyzed"]:
+            skipped.append(os.path.basename(section_path))
+        else:
+            alignments[section_path] = section_alignment
+
+    bg_means = _background_means(data_dir, alignments, background)
+    results_data = Results(data_dir=data_dir)
+
+    rows = []
+    failed = {}
+    with ProcessPoolExecutor(
+        max_workers=num_workers or batch.default_num_workers()
+    ) as executor:
+        futures = {
+            executor.submit(
+                _analyze_section,
+                section_path,
+                section_alignment,
+                bg_means[section_path],
+            ): os.path.basename(section_path)
+            for section_path, section_alignment in alignments.items()
+        }
+
+        for i, future in enumerate(as_completed(futures)):
+            progress = f"({i + 1} / {len(futures)})"
+            try:
+                rows.append(future.result())
+            except Exception as e:
+                failed[futures[future]] = f"{type(e).__name__}: {e}"
+                print(f"{progress} FAILED {futures[future]}: {failed[futures[future]]}")
+                continue
+
+            print(f"{progress} Analyzed {futures[future]}")
+
+    results_data.add_rows(rows)
+
+    return {
+        "analyzed": sorted(i["image_filename"] for i in rows),
+        "skipped": skipped,
+        "failed": failed,
+    }
+
+
+if __name__ == "__main__":
+    mp.freeze_support()
+
+    parser = argparse.ArgumentParser(
+        description="Quantify aligned sections again without the GUI."
+    )
+    parser.add_argument(
+        "--sections-dir",
+        type=str,
+        help="Sections folder opened in the analysis tool",
+        required=True,
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Number of sections processed in parallel"
+    )
+    parser.add_argument(
+        "--background",
+        type=str,
+        choices=BACKGROUND_METHODS,
+        default="saved",
+        help="Use the saved background mean, or compute it again from the saved "
+        "background rectangle on the slide",
+    )
+
+    args = parser.parse_args()
+
+    summary = run_batch(
+        data_dir=args.sections_dir,
+        num_workers=args.workers,
+        background=args.background,
+    )
+
+    print(
+        f"ANALYSIS COMPLETE. {len(summary['analyzed'])} section(s) analyzed, "
+        f"{len(summary['skipped'])} not analyzed skipped, "
+        f"{len(summary['failed'])} failed."
+    )
+    sys.exit(1 if len(summary["failed"]) > 0 else 0)
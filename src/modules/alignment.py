@@ -0,0 +1,186 @@
+"""
+Saved alignments of the sections. For every section the atlas slice, the shift
+applied to the section image, the final ROI polygons and the background are saved in
+an alignment folder next to results.csv, so the analysis tool can restore them when
+the section is opened again and the sections can be quantified again without the
+GUI, see analyze_batch.py.
+
+Alignments are saved as one .npz per section, keyed by the image filename. The ROI
+vertices are packed into a single array with the offsets of the polygons, as in the
+atlas bundle, so loading an alignment is a few array reads. The alignment of analyzed
+ROIs and a draft autosaved while aligning are kept apart, so a draft never replaces
+the alignment the results were computed from. The background of the slide is saved
+once per folder.
+"""
+import os
+
+import numpy as np
+
+import modules.files as files
+
+ALIGNMENT_DIR = "alignment"
+DRAFT_SUFFIX = ".draft"
+BACKGROUND_FILE = "background.npz"
+# increased on every change of the saved alignments
+ALIGNMENT_VERSION = 2
+
+
+def get_alignment_dir(data_dir: str) -> str:
+    # same folder as results.csv, see classes.Results
+    if os.path.basename(data_dir) != "sections":
+        return os.path.join(data_dir, "..", "..", ALIGNMENT_DIR)
+
+    return os.path.join(data_dir, "..", ALIGNMENT_DIR)
+
+
+def _alignment_path(data_dir: str, image_filename: str, draft: bool = False) -> str:
+    stem = os.path.splitext(image_filename)[0]
+    if draft:
+        stem += DRAFT_SUFFIX
+
+    return os.path.join(get_alignment_dir(data_dir), f"{stem}.npz")
+
+
+def _save_arrays(arrays: dict, npz_path: str):
+    os.makedirs(os.path.dirname(npz_path), exist_ok=True)
+
+    with files.atomic_open(npz_path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def save_alignment(
+    data_dir: str,
+    image_filename: str,
+    atlas_slice: int,
+    image_shift: tuple,
+    roi_names: list,
+    roi_polygons: list,
+    background: dict,
+    analyzed: bool = True,
+):
+    """
+    Save the alignment of a section. background has the vertices of the background
+    rectangle on the downscaled slide and the background mean computed from them.
+    With analyzed=False the alignment is saved as a draft, which leaves the alignment
+    of the analyzed ROIs as it is. Saving an analyzed alignment removes the draft.
+    """
+    assert len(roi_names) == len(roi_polygons), "every ROI polygon needs a name"
+
+    roi_polygons = [
+        np.asarray(i, dtype=np.float64).reshape(-1, 2) for i in roi_polygons
+    ]
+    vertex_offsets = np.zeros(len(roi_polygons) + 1, dtype=np.int64)
+    np.cumsum([len(i) for i in roi_polygons], out=vertex_offsets[1:])
+
+    arrays = {
+        "version": np.array(ALIGNMENT_VERSION),
+        "image_filename": np.array(image_filename),
+        # -1 if no slice was selected
+        "atlas_slice": np.array(-1 if atlas_slice is None else int(atlas_slice)),
+        "image_shift": np.array(image_shift, dtype=np.int64),
+        "analyzed": np.array(bool(analyzed)),
+        "roi_names": np.array(roi_names, dtype=str),
+        "vertex_offsets": vertex_offsets,
+        "vertices": (
+            np.concatenate(roi_polygons) if len(roi_polygons) > 0 else np.zeros((0, 2))
+        ),
+        "background_vertices": np.asarray(background["vertices"], dtype=np.float64),
+        "background_mean": np.array(float(background["mean"])),
+    }
+
+    _save_arrays(arrays, _alignment_path(data_dir, image_filename, not analyzed))
+
+    draft_path = _alignment_path(data_dir, image_filename, draft=True)
+    if analyzed and os.path.isfile(draft_path):
+        os.remove(draft_path)
+
+
+def load_alignment(data_dir: str, image_filename: str, draft: bool = False) -> dict:
+    """
+    Saved alignment of the analyzed ROIs of a section, None if the section has not
+    been aligned. With draft=True a draft saved since is returned instead.
+    """
+    alignment_path = _alignment_path(data_dir, image_filename)
+    draft_path = _alignment_path(data_dir, image_filename, draft=True)
+    if draft and os.path.isfile(draft_path):
+        alignment_path = draft_path
+    elif not os.path.isfile(alignment_path):
+        return None
+
+    with np.load(alignment_path) as data:
+        assert (
+            int(data["version"]) == ALIGNMENT_VERSION
+        ), f"{alignment_path} was saved by an unsupported version"
+
+        vertices = data["vertices"]
+        vertex_offsets = data["vertex_offsets"]
+        atlas_slice = int(data["atlas_slice"])
+
+        return {
+            "image_filename": str(data["image_filename"]),
+            "atlas_slice": atlas_slice if atlas_slice >= 0 else None,
+            "image_shift": tuple(int(i) for i in data["image_shift"]),
+            "analyzed": bool(data["analyzed"]),
+            "roi_names": data["roi_names"].tolist(),
+            "roi_polygons": [
+                vertices[start:stop]
+                for start, stop in zip(vertex_offsets[:-1], vertex_offsets[1:])
+            ],
+            "background": {
+                "vertices": data["background_vertices"],
+                "mean": float(data["background_mean"]),
+            },
+        }
+
+
+def saved_rois(section_alignment: dict, atlas_slice: int) -> tuple:
+    """
+    ROI names and polygons of a loaded alignment if they were saved for atlas_slice,
+    None otherwise.
+    """
+    if section_alignment is None or section_alignment["atlas_slice"] != atlas_slice:
+        return None
+    if len(section_alignment["roi_names"]) == 0:
+        return None
+
+    return section_alignment["roi_names"], section_alignment["roi_polygons"]
+
+
+def save_background(data_dir: str, vertices: np.ndarray, mean: float):
+    """Save the background rectangle and mean of the slide of the sections."""
+    _save_arrays(
+        {
+            "version": np.array(ALIGNMENT_VERSION),
+            "vertices": np.asarray(vertices, dtype=np.float64),
+            "mean": np.array(float(mean)),
+        },
+        os.path.join(get_alignment_dir(data_dir), BACKGROUND_FILE),
+    )
+
+
+def load_background(data_dir: str) -> dict:
+    """
+    Saved background of the slide of the sections, None if there is none. Folders
+    aligned before the background was saved on its own use the background of any
+    saved alignment.
+    """
+    alignment_dir = get_alignment_dir(data_dir)
+    background_path = os.path.join(alignment_dir, BACKGROUND_FILE)
+    if os.path.isfile(background_path):
+        with np.load(background_path) as data:
+            return {"vertices": data["vertices"], "mean": float(data["mean"])}
+
+    if not os.path.isdir(alignment_dir):
+        return None
+
+    for fname in sorted(os.listdir(alignment_dir)):
+        if not fname.endswith(".npz"):
+            continue
+
+        with np.load(os.path.join(alignment_dir, fname)) as data:
+            return {
+                "vertices": data["background_vertices"],
+                "mean": float(data["background_mean"]),
+            }
+
+    return None
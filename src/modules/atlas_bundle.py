@@ -0,0 +1,196 @@
+"""
+Compact atlas bundle for the analysis tool. The ROI polygons of roi_shapes.json and
+the slice table of slice_centroids.csv are stored as flat arrays in a single
+uncompressed .npz file, so loading it does no per-vertex work in Python. Regions are
+in the order of roi_colors.json, their colors come from the registry in regions.py.
+
+Polygons are stored as one vertex array. polygon_offsets[level, i] is the first vertex
+of polygon i simplified to simplification_levels[level], shape_offsets[slice *
+n_regions + region] the first polygon of the region in that slice, both end with the
+total count. All levels have the same polygons, only their vertices differ.
+
+The bundle is built by setup_brain_atlas.py, existing atlas folders are converted with
+    python -m modules.atlas_bundle brain_atlas_files/
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import modules.files as files
+
+BUNDLE_FILE = "atlas_bundle.npz"
+# increased on every change of the arrays in the bundle
+BUNDLE_VERSION = 3
+# tolerances in section pixels the polygons are simplified to. the polygons are
+# already simplified with a tolerance of 4 by setup_brain_atlas.py, so only larger
+# tolerances remove more vertices. 0 keeps the polygons as they are
+SIMPLIFICATION_LEVELS = (0, 6, 8, 12, 16)
+# atlas files the bundle is converted from
+SOURCE_FILES = ("roi_shapes.json", "roi_colors.json", "slice_centroids.csv")
+
+
+class AtlasBundle:
+    version = None
+    regions = None
+    simplification_levels = None
+    vertices = None
+    polygon_offsets = None
+    shape_offsets = None
+    slice_table = None
+    slice_table_columns = None
+
+    def __init__(self, arrays: dict):
+        self.version = int(arrays["version"])
+        assert self.version == BUNDLE_VERSION, (
+            f"Atlas bundle version {self.version} is not supported, convert the atlas "
+            f"files again with python -m modules.atlas_bundle"
+        )
+
+        self.regions = [str(i) for i in arrays["regions"]]
+        self.simplification_levels = arrays["simplification_levels"].tolist()
+        self.vertices = arrays["vertices"]
+        self.polygon_offsets = arrays["polygon_offsets"]
+        self.shape_offsets = arrays["shape_offsets"]
+        self.slice_table = arrays["slice_table"]
+        self.slice_table_columns = [str(i) for i in arrays["slice_table_columns"]]
+
+        self._region_index = {r: i for i, r in enumerate(self.regions)}
+        self._level_index = {t: i for i, t in enumerate(self.simplification_levels)}
+
+    @property
+    def n_slices(self) -> int:
+        return (len(self.shape_offsets) - 1) // len(self.regions)
+
+    def polygons(self, slice: int, region: str, simplification: int = 0) -> list:
+        """Polygons of region in slice as (n, 2) vertex arrays, views of the bundle."""
+        assert (
+            simplification in self._level_index
+        ), f"Simplification must be one of {self.simplification_levels}"
+
+        i = slice * len(self.regions) + self._region_index[region]
+        start, stop = self.shape_offsets[i], self.shape_offsets[i + 1]
+        if start == stop:
+            return []
+
+        level = self._level_index[simplification]
+        offsets = self.polygon_offsets[level, start : stop + 1]
+        vertices = self.vertices[offsets[0] : offsets[-1]]
+        return np.split(vertices, offsets[1:-1] - offsets[0])
+
+    def slice_polygons(self, slice: int, simplification: int = 0) -> dict:
+        return {r: self.polygons(slice, r, simplification) for r in self.regions}
+
+    def slice_centroids_dict(self) -> dict:
+        table = self.slice_table
+        columns = self.slice_table_columns
+        slices = table[:, columns.index("slice")].astype(int).tolist()
+        centroids = table[
+            :, [columns.index("centroid_y"), columns.index("centroid_x")]
+        ].tolist()
+
+        return dict(zip(slices, map(tuple, centroids)))
+
+
+def _simplify_polygon(polygon: np.ndarray, tolerance: float) -> np.ndarray:
+    if tolerance == 0 or len(polygon) < 4:
+        return polygon
+
+    # douglas-peucker keeps a subset of the vertices, so they stay integers
+    simplified = shapely.geometry.Polygon(polygon).simplify(tolerance=tolerance)
+    if simplified.is_empty or simplified.geom_type != "Polygon":
+        return polygon
+
+    return np.asarray(simplified.exterior.coords, dtype=polygon.dtype)
+
+
+def _flatten_shapes(roi_shapes: dict, regions: list) -> dict:
+    polygons = [
+        np.asarray(polygon, dtype=np.int16).reshape(-1, 2)
+        for slice in range(len(roi_shapes))
+        for r in regions
+        for polygon in roi_shapes[str(slice)][r]
+    ]
+    counts = [
+        len(roi_shapes[str(slice)][r])
+        for slice in range(len(roi_shapes))
+        for r in regions
+    ]
+
+    # the levels follow each other in the vertex array
+    vertices = [np.zeros((0, 2), dtype=np.int16)]
+    polygon_offsets = np.zeros(
+        (len(SIMPLIFICATION_LEVELS), len(polygons) + 1), dtype=np.int64
+    )
+    n_vertices = 0
+    for level, tolerance in enumerate(SIMPLIFICATION_LEVELS):
+        level_polygons = [_simplify_polygon(i, tolerance) for i in polygons]
+        vertices.extend(level_polygons)
+
+        polygon_offsets[level, 0] = n_vertices
+        np.cumsum([len(i) for i in level_polygons], out=polygon_offsets[level, 1:])
+        polygon_offsets[level, 1:] += n_vertices
+        n_vertices = polygon_offsets[level, -1]
+
+    shape_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=shape_offsets[1:])
+
+    return {
+        "simplification_levels": np.array(SIMPLIFICATION_LEVELS),
+        "vertices": np.concatenate(vertices),
+        "polygon_offsets": polygon_offsets,
+        "shape_offsets": shape_offsets,
+    }
+
+
+def convert_atlas_files(atlas_dir: str) -> dict:
+    """Bundle arrays read from the JSON and CSV files in atlas_dir."""
+    with open(os.path.join(atlas_dir, "roi_colors.json")) as f:
+        roi_colors = json.load(f)
+
+    with open(os.path.join(atlas_dir, "roi_shapes.json")) as f:
+        roi_shapes = json.load(f)
+
+    df = pd.read_csv(os.path.join(atlas_dir, "slice_centroids.csv"))
+
+    regions = list(roi_colors.keys())
+
+    return {
+        "version": np.array(BUNDLE_VERSION),
+        "regions": np.array(regions),
+        **_flatten_shapes(roi_shapes, regions),
+        "slice_table": df.to_numpy(dtype=np.float64),
+        "slice_table_columns": np.array(df.columns.to_list()),
+    }
+
+
+def save_bundle(atlas_dir: str):
+    arrays = convert_atlas_files(atlas_dir)
+
+    bundle_path = os.path.join(atlas_dir, BUNDLE_FILE)
+    with files.atomic_open(bundle_path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def load_bundle(atlas_dir: str) -> AtlasBundle:
+    bundle_path = os.path.join(atlas_dir, BUNDLE_FILE)
+    if not os.path.isfile(bundle_path):
+        # atlas folders set up before the bundle existed
+        return AtlasBundle(convert_atlas_files(atlas_dir))
+
+    with np.load(bundle_path) as data:
+        return AtlasBundle({k: data[k] for k in data.files})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=f"Convert {', '.join(SOURCE_FILES)} to {BUNDLE_FILE}."
+    )
+    parser.add_argument("atlas_dir", type=str, help="Folder with the atlas files")
+    args = parser.parse_args()
+
+    save_bundle(args.atlas_dir)
+    print(f"Saved {os.path.join(args.atlas_dir, BUNDLE_FILE)}")
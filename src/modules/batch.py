@@ -0,0 +1,271 @@
+"""
+Batch scheduling for the preprocessing module. Slides are preprocessed in a process
+pool, one slide per worker. New slides are only started while the estimated memory
+of the running slides stays within the memory budget.
+"""
+import multiprocessing as mp
+import os
+import shutil
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+import modules.preprocessing as preprocessing
+
+# approximate peak memory of preprocessing.run as a multiple of the raw slide size
+# plus the memory of drawing the QC report, which does not depend on the slide size.
+# measured on a 7000x7700 16-bit slide (108 MB) in low-memory mode: 3.3x the raw size
+# without QC, 9.2x with the PDF report. drawing the report alone peaks at about
+# 880 MB for the PDF and 440 MB for the HTML report
+SLIDE_MEMORY_FACTOR = 12
+LOW_MEMORY_SLIDE_MEMORY_FACTOR = 4
+QC_MEMORY = {"pdf": 900 * 1024**2, "html": 450 * 1024**2, "none": 0}
+# share of the available memory used as the default memory budget
+MEMORY_BUDGET_FRACTION = 0.8
+# slides are preprocessed one at a time unless more workers are asked for
+DEFAULT_NUM_WORKERS = 1
+# a slide whose worker process died is run once more on its own before it fails
+MAX_SLIDE_ATTEMPTS = 2
+
+
+def load_data_table(data_path: str) -> pd.DataFrame:
+    assert os.path.isfile(data_path), f"{data_path} does not exist"
+
+    if os.path.splitext(data_path)[1].lower() == ".csv":
+        df = pd.read_csv(data_path)
+    else:
+        df = pd.read_excel(data_path)
+
+    return df
+
+
+def get_slide_dict(data: pd.Series, input_dir: str) -> dict:
+    data_dict = {
+        "image_path": os.path.join(input_dir, data["image_filename"]),
+        "num_slides": data["num_slides"],
+        "num_animals": data["num_animals"],
+        "animal_left_name": data["animal_left_name"],
+        "animal_right_name": data["animal_right_name"],
+    }
+
+    if data_dict["num_animals"] == 2:
+        left = data_dict["animal_left_name"]
+        right = data_dict["animal_right_name"]
+
+        assert (
+            type(left) == str and len(left) > 0
+        ), f"{data_dict['image_path']} is missing animal_left_name"
+
+        assert (
+            type(right) == str and len(right) > 0
+        ), f"{data_dict['image_path']} is missing animal_right_name"
+
+    return data_dict
+
+
+def default_num_workers() -> int:
+    return max(1, mp.cpu_count() - 1)
+
+
+def available_memory() -> int:
+    """Available system memory in bytes, None if it cannot be determined."""
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_memory_budget_gb() -> float:
+    """Memory budget used when none is given, None if the memory is unknown."""
+    memory = available_memory()
+    if memory is None:
+        return None
+
+    return memory * MEMORY_BUDGET_FRACTION / 1024**3
+
+
+def estimate_slide_memory(
+    image_path: str, low_memory: bool = False, qc: str = "pdf"
+) -> int:
+    """Estimated peak memory in bytes needed to preprocess one slide."""
+    try:
+        import tifffile
+
+        with tifffile.TiffFile(image_path) as tif:
+            raw_size = tif.series[0].nbytes
+    except Exception:
+        # fall back to the file size, which is exact for uncompressed TIFFs
+        raw_size = os.path.getsize(image_path)
+
+    if low_memory:
+        return raw_size * LOW_MEMORY_SLIDE_MEMORY_FACTOR + QC_MEMORY[qc]
+
+    return raw_size * SLIDE_MEMORY_FACTOR + QC_MEMORY[qc]
+
+
+def _run_slide(slide: dict, output_dir: str, options: dict) -> dict:
+    start_time = time.perf_counter()
+
+    kwargs = {
+        "image_path": slide["image_path"],
+        "num_slides": slide["num_slides"],
+        "num_animals": slide["num_animals"],
+        "output_dir": output_dir,
+        **options,
+    }
+    if slide["num_animals"] == 2:
+        kwargs["animal_left_name"] = slide["animal_left_name"]
+        kwargs["animal_right_name"] = slide["animal_right_name"]
+
+    try:
+        result = preprocessing.run(**kwargs)
+    except Exception as e:
+        # exceptions are returned as text, not all of them survive pickling
+        return {
+            "error": f"{type(e).__name__}: {e}",
+            "traceback": traceback.format_exc(),
+            "seconds": time.perf_counter() - start_time,
+        }
+
+    return {
+        "error": None,
+        "seconds": time.perf_counter() - start_time,
+        "result": result,
+    }
+
+
+def iter_batch(
+    slides: list,
+    output_dir: str,
+    num_workers: int = None,
+    memory_budget_gb: float = None,
+    options: dict = None,
+):
+    """
+    Preprocess slides in parallel and yield one event per state change.
+
+    Events are (event, index, slide, info) tuples where event is "started",
+    "finished" or "failed". Slides are started in input order. A slide that alone
+    exceeds the memory budget is still run, but never alongside other slides. The
+    default memory budget is MEMORY_BUDGET_FRACTION of the available memory, a budget
+    of 0 means no limit. Slides run one at a time unless num_workers is given.
+    options are passed on to preprocessing.run as keyword arguments.
+
+    If a worker process dies, e.g. killed by the OS when out of memory, the pool is
+    restarted and the slides that were running are started again one at a time. A
+    slide that dies on its own as well fails.
+    """
+    if options is None:
+        options = {}
+
+    if num_workers is None:
+        num_workers = DEFAULT_NUM_WORKERS
+    num_workers = max(1, int(num_workers))
+
+    if memory_budget_gb is None:
+        memory_budget_gb = default_memory_budget_gb()
+
+    memory_budget = None
+    if memory_budget_gb is not None and memory_budget_gb > 0:
+        memory_budget = memory_budget_gb * 1024**3
+
+    # (index, slide, attempt)
+    pending = [(index, slide, 1) for index, slide in enumerate(slides)]
+    running = {}
+    used_memory = 0
+
+    executor = ProcessPoolExecutor(max_workers=num_workers)
+    try:
+        while pending or running:
+            pool_broken = False
+
+            while pending and len(running) < num_workers:
+                index, slide, attempt = pending[0]
+                try:
+                    slide_memory = estimate_slide_memory(
+                        slide["image_path"],
+                        options.get("low_memory", False),
+                        options.get("qc", "pdf"),
+                    )
+                except OSError as e:
+                    pending.pop(0)
+                    yield "failed", index, slide, {"error": str(e), "seconds": 0.0}
+                    continue
+
+                # slides started again after a worker process died run alone
+                runs_alone = attempt > 1 or any(i[3] > 1 for i in running.values())
+                fits_budget = len(running) == 0 or (
+                    not runs_alone
+                    and (
+                        memory_budget is None
+                        or used_memory + slide_memory <= memory_budget
+                    )
+                )
+                if not fits_budget:
+                    break
+
+                try:
+                    future = executor.submit(_run_slide, slide, output_dir, options)
+                except BrokenProcessPool:
+                    pool_broken = True
+                    break
+
+                pending.pop(0)
+                running[future] = (index, slide, slide_memory, attempt)
+                used_memory += slide_memory
+                yield "started", index, slide, {"memory": slide_memory}
+
+            done = set()
+            if running and not pool_broken:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                pool_broken = any(
+                    isinstance(i.exception(), BrokenProcessPool) for i in done
+                )
+
+            # a broken pool fails all of its running slides, they are collected
+            # together and the unfinished ones are started again in a new pool
+            if pool_broken:
+                executor.shutdown(wait=True)
+                done = list(running)
+
+            retried = []
+            for future in done:
+                index, slide, slide_memory, attempt = running.pop(future)
+                used_memory -= slide_memory
+
+                try:
+                    info = future.result()
+                except BrokenProcessPool as e:
+                    if attempt < MAX_SLIDE_ATTEMPTS:
+                        retried.append((index, slide, attempt + 1))
+                        continue
+                    # worker process died, e.g. killed by the OS when out of memory,
+                    # and left its work directory behind
+                    shutil.rmtree(
+                        preprocessing.get_workdir(output_dir, slide["image_path"]),
+                        ignore_errors=True,
+                    )
+                    info = {"error": f"{type(e).__name__}: {e}", "seconds": None}
+                except Exception as e:
+                    info = {"error": f"{type(e).__name__}: {e}", "seconds": None}
+
+                if info["error"] is None:
+                    yield "finished", index, slide, info
+                else:
+                    yield "failed", index, slide, info
+
+            if pool_broken:
+                pending = sorted(retried + pending, key=lambda i: i[0])
+                executor = ProcessPoolExecutor(max_workers=num_workers)
+    finally:
+        executor.shutdown(wait=True)
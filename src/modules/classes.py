@@ -1,11 +1,10 @@
-import json
 import os
 
 import numpy as np
 import pandas as pd
 from skimage import io
 
-ATLAS_DIR = os.path.join(os.path.dirname(__file__), "..", "brain_atlas_files")
+from modules import atlas_bundle, quantification, regions
 
 
 class Background:
@@ -28,9 +27,10 @@ class Background:
 class Atlas:
     image = None
     rois = None
+    contrast_limits = None
     region_column_names = None
     slice_centroids_dict = None
-    roi_shapes_dict = None
+    roi_shapes = None
     selected_slice = None
 
     napari_atlas_layer = None
@@ -41,41 +41,54 @@ class Atlas:
         self,
         image: np.ndarray = None,
         rois: np.ndarray = None,
+        contrast_limits: dict = None,
         region_column_names: list = None,
         slice_centroids_dict: dict = None,
-        roi_shapes_dict: dict = None,
-        roi_colors_dict: dict = None,
+        roi_shapes: atlas_bundle.AtlasBundle = None,
     ):
         self.image = image
         self.rois = rois
+        self.contrast_limits = contrast_limits
         self.region_column_names = region_column_names
         self.slice_centroids_dict = slice_centroids_dict
-        self.roi_shapes_dict = roi_shapes_dict
-        self.roi_colors_dict = roi_colors_dict
+        self.roi_shapes = roi_shapes
 
 
 class SectionImage:
     path = None
     image = None
     name = None
+    shift = None
+    saved_alignment = None
     napari_layer = None
 
     def __init__(self, path: str):
         self.path = path
         self.image = io.imread(path)
         self.name = os.path.basename(path)
+        # rows and columns the image is rolled by to match the atlas slice
+        self.shift = (0, 0)
+        # restored alignment whose ROIs have not been added yet
+        self.saved_alignment = None
 
 
 class Results:
     region_names = None
+    statistic_columns = None
+    columns = None
     data = None
     data_path = None
 
     def __init__(self, data_dir: str = None):
         # init dataframe or load from csv
-        with open(os.path.join(ATLAS_DIR, "roi_colors.json")) as f:
-            data = json.load(f)
-            self.region_names = ["All_ROIs"] + list(data.keys())
+        self.region_names = regions.results_columns()
+        # statistics of every region follow the background subtracted values
+        self.statistic_columns = [
+            f"{r}_{s}"
+            for r in self.region_names
+            for s in quantification.RESULT_STATISTICS
+        ]
+        self.columns = ["image_filename"] + self.region_names + self.statistic_columns
 
         assert os.path.isdir(data_dir)
 
@@ -92,28 +105,41 @@ class Results:
         # load into dataframe
         if os.path.isfile(self.data_path):
             read_data = pd.read_csv(self.data_path)
-            expected_columns = ["image_filename"] + self.region_names
-            if read_data.columns.to_list() == expected_columns:
+            if read_data.columns.to_list() == self.columns:
                 self.data = read_data
+            elif read_data.columns.to_list() == ["image_filename"] + self.region_names:
+                # results saved before the statistics were added, the statistic
+                # columns of the analyzed images stay empty
+                self.data = read_data.reindex(columns=self.columns)
             else:
-                self.data = pd.DataFrame(columns=["image_filename"] + self.region_names)
+                self.data = pd.DataFrame(columns=self.columns)
 
         # else init a new empty dataframe and save to csv
         else:
-            self.data = pd.DataFrame(columns=["image_filename"] + self.region_names)
+            self.data = pd.DataFrame(columns=self.columns)
             self.data.to_csv(self.data_path, index=False)
 
     def add_row(self, row: dict):
-        assert all(key in row for key in self.region_names + ["image_filename"])
+        self.add_rows([row])
 
-        if row["image_filename"] in self.data["image_filename"].values:
-            self.data.loc[
-                self.data["image_filename"] == row["image_filename"]
-            ] = row.values()
+    def add_rows(self, rows: list):
+        """Add the rows or replace those of analyzed images, and save the csv once."""
+        new_rows = []
+        for row in rows:
+            assert all(key in row for key in self.region_names + ["image_filename"])
+            row = {key: row.get(key, np.nan) for key in self.columns}
 
-        else:
-            new_row = pd.DataFrame([row])
-            self.data = pd.concat([self.data, new_row], ignore_index=True)
+            if row["image_filename"] in self.data["image_filename"].values:
+                self.data.loc[
+                    self.data["image_filename"] == row["image_filename"]
+                ] = row.values()
+
+            else:
+                new_rows.append(row)
+
+        if len(new_rows) > 0:
+            new_rows = pd.DataFrame(new_rows)
+            self.data = pd.concat([self.data, new_rows], ignore_index=True)
             self.data = self.data.sort_values("image_filename")
 
         self.data.to_csv(self.data_path, index=False)
@@ -1 +1,16 @@
+import os
+
 DIST_VERSION = "0.2.2"
+
+# BrainGlobe atlas stored directly in brain_atlas_files, other atlases are set up in
+# subfolders named after the atlas
+DEFAULT_ATLAS = "allen_mouse_100um"
+
+
+def get_atlas_dir(atlas_root: str, atlas_name: str) -> str:
+    # atlases other than the default one are set up in subfolders of atlas_root, see
+    # setup_brain_atlas.py --atlas
+    if atlas_name == DEFAULT_ATLAS:
+        return atlas_root
+
+    return os.path.join(atlas_root, atlas_name)
@@ -0,0 +1,25 @@
+"""
+File helpers shared by the scripts. Manifests, atlas files and alignments are written
+to a temporary file first and then renamed, so an interrupted write never leaves a
+truncated file behind.
+"""
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_open(path: str, mode: str = "w"):
+    """
+    Open a temporary file next to path that replaces path when the block exits
+    without errors. The temporary file is removed if the block fails.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, path)
@@ -7,18 +7,49 @@ import os
 import shutil
 
 import numpy as np
+import tifffile
 from scipy import ndimage as ndi
 from skimage import img_as_ubyte, io
 from skimage.feature import peak_local_max
 from skimage.filters import median, threshold_otsu
-from skimage.measure import regionprops, regionprops_table
-from skimage.morphology import binary_opening, remove_small_objects
+from skimage.measure import regionprops_table
 from skimage.segmentation import watershed
-import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
 import pandas as pd
 
-WORKDIR = os.path.join(os.path.dirname(__file__), "workdir")
+import modules.writer as writer
+
+# tissue mask parameters at full resolution
+MEDIAN_SIZE = 11
+OPENING_SIZE = 5
+MIN_OBJECT_SIZE = 6000
+
+# with a factor > 1 an approximate tissue mask is computed on a level downsampled by
+# this factor, 1 gives the exact full-resolution mask. a factor of 4 gave the same
+# section bounding boxes as the exact mask in about 1/15 of the time
+MASK_DOWNSAMPLE = 4
+# number of boundary pixels refined at full resolution at a time
+MASK_REFINE_CHUNK = 16384
+
+# watershed seeds are distance transform maxima in a PEAK_FOOTPRINT window that are
+# at least PEAK_MIN_DISTANCE apart and from the image border
+PEAK_FOOTPRINT = 350
+PEAK_MIN_DISTANCE = 200
+SEPARATION_METHODS = ("components", "watershed")
+
+# rows copied at a time when composing slides in low-memory mode
+LOW_MEMORY_CHUNK = 1024
+
+# side of the square section images
+SECTION_SIZE = 600
+
+# QC report formats, "html" writes PNG images and an index page instead of a PDF
+QC_FORMATS = ("pdf", "html", "none")
+# longest side of the images drawn in the QC report
+QC_MAX_SIZE = 2000
+# resolution of the PNG images of the HTML QC report
+QC_HTML_DPI = 100
 
 
 def _check_image_file(image_path: str) -> bool:
@@ -30,38 +61,564 @@ def _check_image_file(image_path: str) -> bool:
     return True
 
 
-def _configure_dirs(args):
-    shutil.rmtree(WORKDIR, ignore_errors=True)
-    os.makedirs(WORKDIR)
+def get_workdir(output_dir: str, image_path: str) -> str:
+    image_basename = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(output_dir, f".preprocess-{image_basename}")
+
+
+def _configure_dirs(args) -> str:
+    # each job gets its own work directory inside the output directory, so jobs
+    # can run concurrently and the results can be moved with a rename. a work
+    # directory left behind by a killed job is removed when the slide runs again
+    workdir = get_workdir(args["output_dir"], args["image_path"])
+    shutil.rmtree(workdir, ignore_errors=True)
 
     image_basename = os.path.splitext(os.path.basename(args["image_path"]))[0]
 
-    os.makedirs(os.path.join(WORKDIR, image_basename))
-    os.makedirs(os.path.join(WORKDIR, image_basename, "QC"))
+    os.makedirs(os.path.join(workdir, image_basename))
+    os.makedirs(os.path.join(workdir, image_basename, "QC"))
 
     if args["num_animals"] == 2:
         animal_left_name = args["animal_left_name"]
         animal_right_name = args["animal_right_name"]
 
         for i in (animal_left_name, animal_right_name):
-            os.makedirs(os.path.join(WORKDIR, image_basename, i, "sections"))
-            os.makedirs(os.path.join(WORKDIR, image_basename, i, "tiff"))
+            os.makedirs(os.path.join(workdir, image_basename, i, "sections"))
+            os.makedirs(os.path.join(workdir, image_basename, i, "tiff"))
     else:
-        os.makedirs(os.path.join(WORKDIR, image_basename, "sections"))
-        os.makedirs(os.path.join(WORKDIR, image_basename, "tiff"))
+        os.makedirs(os.path.join(workdir, image_basename, "sections"))
+        os.makedirs(os.path.join(workdir, image_basename, "tiff"))
+
+    return workdir
 
 
-def _pad_section(img: np.ndarray, value: int):
-    if img.shape[0] % 2 != 0:
-        img = np.pad(img, pad_width=((0, 1), (0, 0)))
-    if img.shape[1] % 2 != 0:
-        img = np.pad(img, pad_width=((0, 0), (0, 1)))
+def _merge_dirs(source: str, dest: str):
+    for root, _, files in os.walk(source):
+        dest_root = os.path.join(dest, os.path.relpath(root, source))
+        os.makedirs(dest_root, exist_ok=True)
 
-    y = int((value - img.shape[0]) / 2)
-    x = int((value - img.shape[1]) / 2)
-    img = np.pad(img, pad_width=((y, y), (x, x)))
+        for f in files:
+            os.replace(os.path.join(root, f), os.path.join(dest_root, f))
 
-    return img
+
+def _move_to_output(workdir: str, output_dir: str):
+    for i in os.listdir(workdir):
+        # hidden entries are scratch files
+        if i.startswith("."):
+            continue
+
+        source = os.path.join(workdir, i)
+        dest = os.path.join(output_dir, i)
+
+        if not os.path.exists(dest):
+            try:
+                os.rename(source, dest)
+                continue
+            except OSError:
+                # created by another job in the meantime
+                pass
+
+        # replace existing files from a previous run, keep everything else
+        _merge_dirs(source, dest)
+
+    shutil.rmtree(workdir)
+
+
+def _binary_opening_square(mask: np.ndarray, size: int) -> np.ndarray:
+    # a square footprint is separable, two 1D passes give the same result as
+    # binary_opening(mask, np.ones((size, size))), mask is overwritten
+    tmp = np.empty_like(mask)
+    ndi.binary_erosion(mask, np.ones((1, size)), output=tmp, border_value=1)
+    ndi.binary_erosion(tmp, np.ones((size, 1)), output=mask, border_value=1)
+    ndi.binary_dilation(mask, np.ones((1, size)), output=tmp)
+    ndi.binary_dilation(tmp, np.ones((size, 1)), output=mask)
+    return mask
+
+
+def _downsample_mean(img: np.ndarray, factor: int) -> np.ndarray:
+    h = img.shape[0] // factor
+    w = img.shape[1] // factor
+    small = np.empty((h, w), dtype=np.float32)
+
+    # a few rows at a time to avoid a full-size float copy of the slide
+    chunk = max(1, LOW_MEMORY_CHUNK // factor)
+    for start in range(0, h, chunk):
+        stop = min(start + chunk, h)
+        blocks = img[start * factor : stop * factor, : w * factor]
+        blocks = blocks.reshape(stop - start, factor, w, factor)
+        small[start:stop] = blocks.mean(axis=(1, 3), dtype=np.float32)
+
+    return small
+
+
+def _upsample_mask(mask: np.ndarray, factor: int, shape: tuple) -> np.ndarray:
+    out = np.empty(shape, dtype=bool)
+    h, w = mask.shape[0] * factor, mask.shape[1] * factor
+    for y in range(factor):
+        for x in range(factor):
+            out[y:h:factor, x:w:factor] = mask
+
+    # remaining rows and columns repeat the edge
+    out[h:, :w] = out[h - 1 : h, :w]
+    out[:, w:] = out[:, w - 1 : w]
+    return out
+
+
+def _label_compact(mask: np.ndarray, structure=None) -> np.ndarray:
+    try:
+        labels = np.empty(mask.shape, dtype=np.uint16)
+        ndi.label(mask, structure=structure, output=labels)
+    except RuntimeError:
+        labels = np.empty(mask.shape, dtype=np.int32)
+        ndi.label(mask, structure=structure, output=labels)
+
+    return labels
+
+
+def _fill_holes(mask: np.ndarray) -> np.ndarray:
+    # same result as ndi.binary_fill_holes, but filled per 8-connected object on
+    # its bounding box, which needs far less memory than filling the whole slide,
+    # mask is overwritten
+    labels = _label_compact(mask, structure=np.ones((3, 3)))
+    for i, bbox in enumerate(ndi.find_objects(labels)):
+        mask[bbox] |= ndi.binary_fill_holes(labels[bbox] == i + 1)
+
+    return mask
+
+
+def _remove_small_objects(mask: np.ndarray, min_size: int) -> np.ndarray:
+    # same result as skimage.morphology.remove_small_objects, but with 16-bit
+    # labels when possible and without full-size 64-bit temporaries, mask is
+    # overwritten
+    labels = _label_compact(mask)
+    num_labels = int(labels.max())
+
+    # bincount and indexing convert labels to 64-bit, so only a few rows at a time
+    chunk = max(1, LOW_MEMORY_CHUNK**2 // mask.shape[1])
+
+    sizes = np.zeros(num_labels + 1, dtype=np.int64)
+    for start in range(0, mask.shape[0], chunk):
+        rows = labels[start : start + chunk].ravel()
+        sizes += np.bincount(rows, minlength=num_labels + 1)
+
+    keep = sizes >= min_size
+    keep[0] = False
+
+    for start in range(0, mask.shape[0], chunk):
+        rows = slice(start, start + chunk)
+        mask[rows] &= keep[labels[rows]]
+
+    return mask
+
+
+def _threshold_otsu(img: np.ndarray):
+    # same result as skimage.filters.threshold_otsu, but the histogram of an integer
+    # image is counted a few rows at a time instead of from a 64-bit copy of it
+    if not np.issubdtype(img.dtype, np.integer):
+        return threshold_otsu(img)
+
+    image_min, image_max = int(img.min()), int(img.max())
+    if image_min == image_max:
+        return img.reshape(-1)[0]
+
+    counts = np.zeros(image_max - image_min + 1, dtype=np.int64)
+    chunk = max(1, LOW_MEMORY_CHUNK**2 // img.shape[1])
+    for start in range(0, img.shape[0], chunk):
+        rows = img[start : start + chunk].ravel().astype(np.int64) - image_min
+        counts += np.bincount(rows, minlength=counts.size)
+
+    return threshold_otsu(hist=(counts, np.arange(image_min, image_max + 1)))
+
+
+def _median_at(img: np.ndarray, y: np.ndarray, x: np.ndarray, size: int):
+    # median filter evaluated only at the given pixels, edges are handled like
+    # mode="nearest" in scipy.ndimage.median_filter
+    offsets = np.arange(size) - size // 2
+    rows = np.clip(y[:, None] + offsets, 0, img.shape[0] - 1)
+    cols = np.clip(x[:, None] + offsets, 0, img.shape[1] - 1)
+    values = img[rows[:, :, None], cols[:, None, :]].reshape(len(y), size * size)
+    return np.partition(values, size * size // 2, axis=1)[:, size * size // 2]
+
+
+def _tissue_mask(img: np.ndarray, downsample: int = MASK_DOWNSAMPLE) -> np.ndarray:
+    """
+    Mask of the tissue sections on a slide.
+
+    downsample=1 computes the mask at full resolution: 11x11 median filter, Otsu
+    threshold, hole filling, opening and small object removal.
+
+    With downsample > 1 the mask is an approximation. The median filter, Otsu
+    threshold and object filtering are first run on a downsampled level, and the
+    full-resolution median filter is then only computed in a narrow band along the
+    coarse object boundaries, everywhere else the upsampled coarse mask is used. The
+    threshold of the downsampled level differs slightly from the full-resolution one
+    and pixels outside the band are not refined, so object boundaries can move by a
+    few pixels.
+    """
+    if downsample <= 1 or min(img.shape) < downsample * 2 * MEDIAN_SIZE:
+        blurred = median(img, np.ones((MEDIAN_SIZE, MEDIAN_SIZE)))
+        mask = blurred > _threshold_otsu(blurred)
+        del blurred
+
+        mask = _fill_holes(mask)
+        mask = _binary_opening_square(mask, OPENING_SIZE)
+        return _remove_small_objects(mask, MIN_OBJECT_SIZE)
+
+    # coarse mask
+    small = _downsample_mean(img, downsample)
+    small_median_size = max(3, MEDIAN_SIZE // downsample // 2 * 2 + 1)
+    small_blurred = ndi.median_filter(
+        small, footprint=np.ones((small_median_size, small_median_size))
+    )
+    threshold_value = threshold_otsu(small_blurred)
+    coarse = ndi.binary_fill_holes(small_blurred > threshold_value)
+
+    # only drop objects well below the size limit here, borderline objects are
+    # decided at full resolution
+    coarse = _remove_small_objects(coarse, MIN_OBJECT_SIZE // downsample**2 // 2)
+
+    # band of coarse pixels whose full-resolution values may differ
+    band = ndi.binary_dilation(coarse, iterations=2) & ~ndi.binary_erosion(
+        coarse, iterations=2, border_value=1
+    )
+
+    mask = _upsample_mask(coarse, downsample, img.shape)
+    del coarse
+
+    def _refine(y, x):
+        blurred = _median_at(img, y, x, MEDIAN_SIZE)
+        mask[y, x] = blurred > threshold_value
+
+    # refine the band at full resolution, each band pixel covers a block of
+    # downsample x downsample pixels
+    band_y, band_x = np.nonzero(band)
+    del band
+    block_y, block_x = np.divmod(np.arange(downsample**2), downsample)
+    chunk = max(1, MASK_REFINE_CHUNK // downsample**2)
+    for i in range(0, band_y.size, chunk):
+        y = (band_y[i : i + chunk, None] * downsample + block_y).ravel()
+        x = (band_x[i : i + chunk, None] * downsample + block_x).ravel()
+        _refine(y, x)
+
+    # the rows and columns beyond the last full block are always refined
+    h = img.shape[0] // downsample * downsample
+    w = img.shape[1] // downsample * downsample
+    for rows, cols in (
+        (slice(h, img.shape[0]), slice(0, img.shape[1])),
+        (slice(0, h), slice(w, img.shape[1])),
+    ):
+        y, x = np.mgrid[rows, cols]
+        if y.size > 0:
+            _refine(y.ravel(), x.ravel())
+
+    mask = _fill_holes(mask)
+    mask = _binary_opening_square(mask, OPENING_SIZE)
+    return _remove_small_objects(mask, MIN_OBJECT_SIZE)
+
+
+def _watershed_sections(mask: np.ndarray) -> np.ndarray:
+    distance = ndi.distance_transform_edt(mask)
+    coords = peak_local_max(
+        distance,
+        footprint=np.ones((PEAK_FOOTPRINT, PEAK_FOOTPRINT)),
+        labels=mask,
+        min_distance=PEAK_MIN_DISTANCE,
+    )
+    peaks = np.zeros(distance.shape, dtype=bool)
+    peaks[tuple(coords.T)] = True
+    markers, _ = ndi.label(peaks)
+    return watershed(-distance, markers=markers, mask=mask)
+
+
+def _component_sections(mask: np.ndarray, dtype=np.int32) -> np.ndarray:
+    """
+    Sections of _watershed_sections, which stays the reference, with the distance
+    transform, seed search and watershed run separately for each connected component
+    on its bounding box. Only seed candidates are compared between components, so no
+    maximum filter or watershed is run over the whole slide. The seeds are the same,
+    but the watershed breaks ties in the order of its queue, so pixels on flat parts
+    of the distance transform between two seeds, as in straight tissue edges, can be
+    given to the other section.
+    """
+    components = np.zeros(mask.shape, dtype=dtype)
+    ndi.label(mask, output=components)
+    half = PEAK_FOOTPRINT // 2
+    interior = (
+        slice(PEAK_MIN_DISTANCE, mask.shape[0] - PEAK_MIN_DISTANCE),
+        slice(PEAK_MIN_DISTANCE, mask.shape[1] - PEAK_MIN_DISTANCE),
+    )
+
+    crops = []
+    max_distances = []
+    candidates = []
+
+    def _distance(i):
+        return ndi.distance_transform_edt(components[crops[i]] == i + 1)
+
+    for i, bbox in enumerate(ndi.find_objects(components)):
+        # one pixel of background around the component keeps the distance
+        # transform equal to the one of the whole slide
+        crop = tuple(
+            slice(max(s.start - 1, 0), min(s.stop + 1, n))
+            for s, n in zip(bbox, mask.shape)
+        )
+        crops.append(crop)
+        distance = _distance(i)
+        max_distances.append(distance.max())
+
+        # seeds are not searched near the slide border
+        peak_crop = tuple(
+            slice(max(s.start, b.start), min(s.stop, b.stop))
+            for s, b in zip(crop, interior)
+        )
+        if any(s.start >= s.stop for s in peak_crop):
+            continue
+
+        offset = [p.start - c.start for p, c in zip(peak_crop, crop)]
+        coords = peak_local_max(
+            distance[
+                offset[0] : offset[0] + peak_crop[0].stop - peak_crop[0].start,
+                offset[1] : offset[1] + peak_crop[1].stop - peak_crop[1].start,
+            ],
+            footprint=np.ones((PEAK_FOOTPRINT, PEAK_FOOTPRINT)),
+            min_distance=1,
+            threshold_abs=0,
+            exclude_border=False,
+        )
+        for y, x in coords + offset:
+            candidates.append((distance[y, x], y + crop[0].start, x + crop[1].start, i))
+
+    # drop candidates that are not maxima once the other components are included,
+    # distance transforms are not kept and only recomputed for components that
+    # are near a candidate and could be higher
+    def _window(y, x):
+        return (
+            slice(max(y - half, interior[0].start), min(y + half, interior[0].stop)),
+            slice(max(x - half, interior[1].start), min(x + half, interior[1].stop)),
+        )
+
+    suppressed = set()
+    for j, crop in enumerate(crops):
+        distance = None
+        for k, (value, y, x, component_index) in enumerate(candidates):
+            if component_index == j or k in suppressed:
+                continue
+            if max_distances[j] <= value:
+                continue
+
+            overlap = [
+                slice(max(w.start, c.start), min(w.stop, c.stop))
+                for w, c in zip(_window(y, x), crop)
+            ]
+            if any(o.start >= o.stop for o in overlap):
+                continue
+
+            if distance is None:
+                distance = _distance(j)
+            other = distance[
+                overlap[0].start - crop[0].start : overlap[0].stop - crop[0].start,
+                overlap[1].start - crop[1].start : overlap[1].stop - crop[1].start,
+            ]
+            if other.max() > value:
+                suppressed.add(k)
+
+    candidates = [c for k, c in enumerate(candidates) if k not in suppressed]
+
+    # keep the highest seeds that are more than PEAK_MIN_DISTANCE apart, visiting
+    # equal values in raster order like peak_local_max
+    candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+    seeds = []
+    for value, y, x, component_index in candidates:
+        if all(max(abs(y - s[0]), abs(x - s[1])) > PEAK_MIN_DISTANCE for s in seeds):
+            seeds.append((y, x, component_index))
+
+    # number sections in the raster order of their seeds like _watershed_sections
+    seeds.sort()
+    labels = np.zeros(mask.shape, dtype=dtype)
+    for i, crop in enumerate(crops):
+        component_seeds = [
+            (label_value, y, x)
+            for label_value, (y, x, j) in enumerate(seeds, start=1)
+            if j == i
+        ]
+        if len(component_seeds) == 0:
+            continue
+
+        component = components[crop] == i + 1
+        if len(component_seeds) == 1:
+            labels[crop][component] = component_seeds[0][0]
+            continue
+
+        markers = np.zeros(component.shape, dtype=np.int32)
+        for label_value, y, x in component_seeds:
+            markers[y - crop[0].start, x - crop[1].start] = label_value
+        component_labels = watershed(-_distance(i), markers=markers, mask=component)
+        labels[crop][component] = component_labels[component]
+
+    return labels
+
+
+def _separate_sections(
+    mask: np.ndarray, method: str = "components", dtype=np.int32
+) -> np.ndarray:
+    if method == "watershed":
+        return _watershed_sections(mask)
+    if method == "components":
+        return _component_sections(mask, dtype)
+
+    raise ValueError(
+        f"Unknown section separation method {method}, "
+        f"use one of {SEPARATION_METHODS}."
+    )
+
+
+def _read_slide(image_path: str, low_memory: bool, scratch_dir: str) -> np.ndarray:
+    if not low_memory:
+        return io.imread(image_path)
+
+    try:
+        return tifffile.memmap(image_path, mode="r")
+    except ValueError:
+        # compressed or tiled TIFF, decode it into a disk-backed array instead
+        return tifffile.imread(image_path, out=os.path.join(scratch_dir, "slide.raw"))
+
+
+def _compose_slides(img: np.ndarray, scratch_dir: str) -> np.ndarray:
+    # low-memory version of
+    # np.hstack((np.rot90(img[:, 0:sep_x_val], 2), img[:, sep_x_val:]))
+    # that fills a disk-backed array a few rows at a time
+    sep_x_val = int(img.shape[1] / 2)
+    composed = np.lib.format.open_memmap(
+        os.path.join(scratch_dir, "composed.npy"),
+        mode="w+",
+        dtype=img.dtype,
+        shape=img.shape,
+    )
+
+    height = img.shape[0]
+    for start in range(0, height, LOW_MEMORY_CHUNK):
+        stop = min(start + LOW_MEMORY_CHUNK, height)
+        composed[start:stop, :sep_x_val] = img[
+            height - stop : height - start, sep_x_val - 1 :: -1
+        ][::-1]
+        composed[start:stop, sep_x_val:] = img[start:stop, sep_x_val:]
+
+    composed.flush()
+    return composed
+
+
+def _qc_step(shape: tuple) -> int:
+    # the QC figures are about QC_MAX_SIZE pixels wide, drawing the full slide
+    # only makes matplotlib resample a copy of it
+    return max(1, int(np.ceil(max(shape) / QC_MAX_SIZE)))
+
+
+def _qc_view(img: np.ndarray, step: int) -> np.ndarray:
+    return np.ascontiguousarray(img[::step, ::step])
+
+
+def _qc_figures(
+    raw_img: np.ndarray,
+    rotated_img: np.ndarray,
+    labels: np.ndarray,
+    props_table: pd.DataFrame,
+) -> list:
+    # figures are created without pyplot, so they are freed with the report and
+    # can be drawn outside the main thread
+    font = {"color": "black", "weight": "bold", "size": 4}
+
+    qc_raw_img = _qc_view(raw_img, _qc_step(raw_img.shape))
+    # pixel (y, x) of the rotated image is at (y / step, x / step) in the figure
+    step = _qc_step(rotated_img.shape)
+    qc_rotated_img = _qc_view(rotated_img, step)
+    qc_labels = _qc_view(labels, step)
+
+    figures = []
+    for title, img in (
+        ("Raw image", qc_raw_img),
+        ("Rotated image", qc_rotated_img),
+        ("Identified slices", qc_rotated_img),
+    ):
+        fig = Figure(figsize=(10, 10), dpi=300)
+        ax = fig.subplots()
+        ax.imshow(img, cmap="Greys")
+        ax.set_title(title)
+        ax.set_rasterized(True)
+        ax.get_xaxis().set_visible(False)
+        ax.get_yaxis().set_visible(False)
+        figures.append((title, fig))
+
+    ax.imshow(qc_labels, cmap="rainbow", alpha=0.3 * (qc_labels > 0))
+
+    for _, row in props_table.iterrows():
+        ax.text(
+            row["centroid-1"] / step,
+            row["centroid-0"] / step,
+            row["name"],
+            ha="center",
+            va="center",
+            rotation=25,
+            fontdict=font,
+        )
+
+    return figures
+
+
+def _write_qc(
+    qc_dir: str,
+    qc_format: str,
+    raw_img: np.ndarray,
+    rotated_img: np.ndarray,
+    labels: np.ndarray,
+    props_table: pd.DataFrame,
+):
+    figures = _qc_figures(raw_img, rotated_img, labels, props_table)
+
+    if qc_format == "pdf":
+        with PdfPages(os.path.join(qc_dir, "processing_QC.pdf")) as pp:
+            for _, fig in figures:
+                pp.savefig(fig)
+        return
+
+    rows = []
+    for i, (title, fig) in enumerate(figures):
+        fname = f"processing_QC_{i + 1}.png"
+        fig.savefig(os.path.join(qc_dir, fname), dpi=QC_HTML_DPI)
+        rows.append(f'<h2>{title}</h2>\n<img src="{fname}" width="800">')
+
+    with open(os.path.join(qc_dir, "processing_QC.html"), "w") as f:
+        f.write(
+            "<!DOCTYPE html>\n<html>\n<head><title>Processing QC</title></head>\n"
+            "<body>\n" + "\n".join(rows) + "\n</body>\n</html>\n"
+        )
+
+
+def _section_image(
+    rotated_img: np.ndarray,
+    labels: np.ndarray,
+    label: int,
+    bbox: np.ndarray,
+    size: int,
+) -> np.ndarray:
+    # the section is centered in a size x size image like padding its bounding box,
+    # with odd sides rounded up, on both sides would do. larger sections are
+    # center-cropped to size
+    section = np.zeros((size, size), dtype=rotated_img.dtype)
+
+    source = []
+    dest = []
+    for start, stop in ((bbox[0], bbox[2]), (bbox[1], bbox[3])):
+        length = stop - start
+        offset = (size - length - length % 2) // 2
+        crop = max(-offset, 0)
+        n = min(length - crop, size - max(offset, 0))
+        source.append(slice(start + crop, start + crop + n))
+        dest.append(slice(max(offset, 0), max(offset, 0) + n))
+
+    source = tuple(source)
+    np.copyto(section[tuple(dest)], rotated_img[source], where=labels[source] == label)
+
+    return section
 
 
 def run(
@@ -71,25 +628,93 @@ def run(
     output_dir: str,
     animal_left_name: str = None,
     animal_right_name: str = None,
+    mask_downsample: int = MASK_DOWNSAMPLE,
+    separation: str = "components",
+    low_memory: bool = False,
+    qc: str = "pdf",
+    compression: str = "none",
+    tiled: bool = False,
 ):
+    """
+    Split one slide image into sections and write them to output_dir.
+
+    With low_memory=True the slide is memory-mapped (or decoded into a disk-backed
+    file in the work directory) instead of being read into memory, two-slide images
+    are composed on disk and section labels use 16-bit integers where possible.
+    Peak memory is then roughly 3.5 times the raw size of a 16-bit slide, the
+    operating system page cache aside, plus up to about 900 MB for drawing the QC
+    report, see batch.QC_MEMORY.
+
+    qc is one of QC_FORMATS. The QC report is drawn from downsampled images while
+    the slide is written, "none" skips it.
+
+    Output TIFFs are written in the background with one of writer.COMPRESSIONS,
+    tiled=True writes the full slide in tiles.
+    """
     _check_image_file(image_path)
-    _configure_dirs(
+    if qc not in QC_FORMATS:
+        raise ValueError(f"Unknown QC format {qc}, use one of {QC_FORMATS}.")
+    writer.check_compression(compression)
+
+    workdir = _configure_dirs(
         {
             "image_path": image_path,
             "num_animals": num_animals,
             "animal_left_name": animal_left_name,
             "animal_right_name": animal_right_name,
+            "output_dir": output_dir,
         }
     )
 
+    try:
+        section_names = _process_slide(
+            image_path=image_path,
+            num_slides=num_slides,
+            num_animals=num_animals,
+            workdir=workdir,
+            animal_left_name=animal_left_name,
+            animal_right_name=animal_right_name,
+            mask_downsample=mask_downsample,
+            separation=separation,
+            low_memory=low_memory,
+            qc=qc,
+            compression=compression,
+            tiled=tiled,
+        )
+    except BaseException:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+
+    _move_to_output(workdir, output_dir)
+
+    return {
+        "image_path": image_path,
+        "num_sections": len(section_names),
+        "sections": section_names,
+    }
+
+
+def _process_slide(
+    image_path: str,
+    num_slides: int,
+    num_animals: int,
+    workdir: str,
+    animal_left_name: str = None,
+    animal_right_name: str = None,
+    mask_downsample: int = MASK_DOWNSAMPLE,
+    separation: str = "components",
+    low_memory: bool = False,
+    qc: str = "pdf",
+    compression: str = "none",
+    tiled: bool = False,
+):
+    scratch_dir = os.path.join(workdir, ".scratch")
+    os.makedirs(scratch_dir)
+
     # load image and identify large objects
-    img = io.imread(image_path)
-    blurred = median(img, np.ones((11, 11)))
-    threshold_value = threshold_otsu(blurred)
-    thresholded = blurred > threshold_value
-    fill_holes = ndi.binary_fill_holes(thresholded)
-    fill_holes = binary_opening(fill_holes, np.ones((5, 5)))
-    large_objects_only = img_as_ubyte(remove_small_objects(fill_holes, 6000))
+    raw_img = _read_slide(image_path, low_memory, scratch_dir)
+    img = raw_img
+    large_objects_only = img_as_ubyte(_tissue_mask(img, mask_downsample))
 
     # rotate the image parts
     sep_x_val = int(img.shape[1] / 2)
@@ -101,152 +726,110 @@ def run(
             )
         )
 
-        img = np.hstack((np.rot90(img[:, 0:sep_x_val], 2), img[:, sep_x_val:]))
+        if low_memory:
+            img = _compose_slides(img, scratch_dir)
+        else:
+            img = np.hstack((np.rot90(img[:, 0:sep_x_val], 2), img[:, sep_x_val:]))
 
     large_objects_only = np.rot90(large_objects_only, 1)
     rotated_img = np.rot90(img, 1)
 
-    # watershed segmentation
-    distance = ndi.distance_transform_edt(large_objects_only)
-    coords = peak_local_max(
-        distance,
-        footprint=np.ones((350, 350)),
-        labels=large_objects_only,
-        min_distance=200,
-    )
-    mask = np.zeros(distance.shape, dtype=bool)
-    mask[tuple(coords.T)] = True
-    markers, _ = ndi.label(mask)
-    labels = watershed(-distance, markers=markers, mask=large_objects_only)
+    # split touching sections
+    label_dtype = np.int32
+    if low_memory and large_objects_only.size // MIN_OBJECT_SIZE < 2**16:
+        label_dtype = np.uint16
+    labels = _separate_sections(large_objects_only, separation, label_dtype)
+    del large_objects_only
 
     # read region properties
-    props = regionprops(label_image=labels, intensity_image=rotated_img)
     props_table = pd.DataFrame(
         regionprops_table(
             label_image=labels,
-            intensity_image=rotated_img,
-            properties=("label", "centroid"),
+            properties=("label", "centroid", "bbox"),
         )
     )
+    bboxes = props_table[["bbox-0", "bbox-1", "bbox-2", "bbox-3"]].to_numpy()
+
+    image_basename = os.path.splitext(os.path.basename(image_path))[0]
+    sep_x_val = int(img.shape[1] / 2)
 
     right = 0
     left = 0
+    section_fnames = []
+
+    # sections, the QC report and the slide are written in the background
+    with writer.TiffWriter(compression=compression) as tiff_writer:
+        for i, (label, centroid) in enumerate(
+            zip(props_table["label"], props_table["centroid-0"])
+        ):
+            section = _section_image(
+                rotated_img, labels, label, bboxes[i], SECTION_SIZE
+            )
 
-    for i, p in enumerate(props):
-        section = p.image_intensity
-        section = _pad_section(section, 600)
-
-        image_basename = os.path.splitext(os.path.basename(image_path))[0]
-        sep_x_val = int(img.shape[1] / 2)
-
-        if num_slides == 2:
-            if p.centroid[0] < sep_x_val:
-                if num_animals == 2:
-                    fname = os.path.join(
-                        animal_right_name,
-                        "sections",
-                        f"{animal_right_name}_{str(right).zfill(3)}.tif",
-                    )
+            if num_slides == 2:
+                if centroid < sep_x_val:
+                    if num_animals == 2:
+                        fname = os.path.join(
+                            animal_right_name,
+                            "sections",
+                            f"{animal_right_name}_{str(right).zfill(3)}.tif",
+                        )
+                    else:
+                        fname = os.path.join(
+                            "sections",
+                            f"{image_basename}_1_{str(right).zfill(3)}.tif",
+                        )
+                    right += 1
                 else:
-                    fname = os.path.join(
-                        "sections", f"{image_basename}_1_{str(right).zfill(3)}.tif"
-                    )
-                right += 1
+                    if num_animals == 2:
+                        fname = os.path.join(
+                            animal_left_name,
+                            "sections",
+                            f"{animal_left_name}_{str(left).zfill(3)}.tif",
+                        )
+                    else:
+                        fname = os.path.join(
+                            "sections",
+                            f"{image_basename}_2_{str(left).zfill(3)}.tif",
+                        )
+                    left += 1
             else:
-                if num_animals == 2:
-                    fname = os.path.join(
-                        animal_left_name,
-                        "sections",
-                        f"{animal_left_name}_{str(left).zfill(3)}.tif",
-                    )
-                else:
-                    fname = os.path.join(
-                        "sections", f"{image_basename}_2_{str(left).zfill(3)}.tif"
-                    )
-                left += 1
-        else:
-            fname = os.path.join("sections", f"{image_basename}_{str(i).zfill(3)}.tif")
-
-        io.imsave(os.path.join(WORKDIR, image_basename, fname), section)
-
-        props_table.loc[i, "name"] = os.path.basename(fname).strip(".tif")
-
-    # save raw image file
-    image_basename = os.path.splitext(os.path.basename(image_path))[0]
-    if num_animals == 2:
-        left_fpath = os.path.join(
-            WORKDIR,
-            image_basename,
-            animal_left_name,
-            "tiff",
-            f"{image_basename}.tif",
-        )
-        io.imsave(left_fpath, img)
-
-        right_fpath = os.path.join(
-            WORKDIR,
-            image_basename,
-            animal_right_name,
-            "tiff",
-            f"{image_basename}.tif",
-        )
-        io.imsave(right_fpath, img)
-    else:
-        fpath = os.path.join(WORKDIR, image_basename, "tiff", f"{image_basename}.tif")
-        io.imsave(fpath, img)
-
-    font = {"color": "black", "weight": "bold", "size": 4}
-
-    fig1, ax = plt.subplots(figsize=(10, 10), dpi=300)
-    plt.imshow(io.imread(image_path), cmap="Greys")
-    plt.title("Raw image")
-    ax.set_rasterized(True)
-    ax.get_xaxis().set_visible(False)
-    ax.get_yaxis().set_visible(False)
-
-    fig2, ax = plt.subplots(figsize=(10, 10), dpi=300)
-    plt.imshow(rotated_img, cmap="Greys")
-    plt.title("Rotated image")
-    ax.set_rasterized(True)
-    ax.get_xaxis().set_visible(False)
-    ax.get_yaxis().set_visible(False)
-
-    fig3, ax = plt.subplots(figsize=(10, 10), dpi=300)
-    plt.imshow(rotated_img, cmap="Greys")
-    plt.imshow(labels, cmap="rainbow", alpha=0.3 * (labels > 0))
-    plt.title("Identified slices")
-    ax.set_rasterized(True)
-    ax.get_xaxis().set_visible(False)
-    ax.get_yaxis().set_visible(False)
-
-    for _, row in props_table.iterrows():
-        plt.text(
-            row["centroid-1"],
-            row["centroid-0"],
-            row["name"],
-            ha="center",
-            va="center",
-            rotation=25,
-            fontdict=font,
-        )
+                fname = os.path.join(
+                    "sections", f"{image_basename}_{str(i).zfill(3)}.tif"
+                )
+
+            tiff_writer.write(os.path.join(workdir, image_basename, fname), section)
+            section_fnames.append(fname)
+
+            props_table.loc[i, "name"] = os.path.splitext(os.path.basename(fname))[0]
+
+        # the QC report is drawn while the slide is written
+        if qc != "none":
+            tiff_writer.submit(
+                _write_qc,
+                os.path.join(workdir, image_basename, "QC"),
+                qc,
+                raw_img,
+                rotated_img,
+                labels,
+                props_table,
+            )
 
-    pdfpath = os.path.join(WORKDIR, image_basename, "QC", "processing_QC.pdf")
-    pp = PdfPages(pdfpath)
-    pp.savefig(fig1)
-    pp.savefig(fig2)
-    pp.savefig(fig3)
-    pp.close()
-
-    # move everything to selected output dir
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-    workdir_contents = os.listdir(WORKDIR)
-    for i in workdir_contents:
-        source = os.path.join(WORKDIR, i)
-        dest = os.path.join(output_dir, i)
-        shutil.copytree(source, dest, dirs_exist_ok=True)
+        # save raw image file, written once and linked for the second animal
+        if num_animals == 2:
+            fpaths = [
+                os.path.join(
+                    workdir, image_basename, name, "tiff", f"{image_basename}.tif"
+                )
+                for name in (animal_left_name, animal_right_name)
+            ]
+        else:
+            fpaths = [
+                os.path.join(workdir, image_basename, "tiff", f"{image_basename}.tif")
+            ]
+        tiff_writer.write(fpaths[0], img, tiled=tiled, links=fpaths[1:])
 
-    shutil.rmtree(WORKDIR)
+    return [os.path.join(image_basename, i) for i in section_fnames]
 
 
 if __name__ == "__main__":
@@ -267,193 +850,70 @@ if __name__ == "__main__":
     parser.add_argument(
         "--output-dir", type=str, help="Output directory", required=True
     )
+    parser.add_argument(
+        "--mask-downsample",
+        type=int,
+        default=MASK_DOWNSAMPLE,
+        help="Downsampling factor of an approximate tissue mask (default: 4), 1 "
+        "computes the exact mask at full resolution",
+    )
+    parser.add_argument(
+        "--separation",
+        type=str,
+        choices=SEPARATION_METHODS,
+        default="components",
+        help="Method used to split the tissue mask into sections, watershed is the "
+        "reference and components is faster",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Memory-map the slide and keep intermediate images on disk",
+    )
+    parser.add_argument(
+        "--qc",
+        type=str,
+        choices=QC_FORMATS,
+        default="pdf",
+        help="Format of the QC report",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=tuple(writer.COMPRESSIONS),
+        default="none",
+        help="Lossless compression of the output TIFFs",
+    )
+    parser.add_argument(
+        "--tiled", action="store_true", help="Write the full slide as a tiled TIFF"
+    )
     parser.add_argument(
         "--with-napari", action="store_true", help="Enable napari for inspection"
     )
 
     args = parser.parse_args()
 
+    result = run(
+        image_path=args.image_path,
+        num_slides=args.num_slides,
+        num_animals=args.num_animals,
+        output_dir=args.output_dir,
+        animal_left_name=args.animal_left_name,
+        animal_right_name=args.animal_right_name,
+        mask_downsample=args.mask_downsample,
+        separation=args.separation,
+        low_memory=args.low_memory,
+        qc=args.qc,
+        compression=args.compression,
+        tiled=args.tiled,
+    )
+
     if (args.with_napari) is True:
         import napari
 
         viewer = napari.Viewer()
-
-    _check_image_file(args.image_path)
-    _configure_dirs(args)
-
-    # load image and identify large objects
-    img = io.imread(args.image_path)
-    blurred = median(img, np.ones((11, 11)))
-    threshold_value = threshold_otsu(blurred)
-    thresholded = blurred > threshold_value
-    fill_holes = ndi.binary_fill_holes(thresholded)
-    fill_holes = binary_opening(fill_holes, np.ones((5, 5)))
-    large_objects_only = img_as_ubyte(remove_small_objects(fill_holes, 6000))
-
-    if (args.with_napari) is True:
-        viewer.add_image(img, name="img")
-        viewer.add_image(blurred, name="blurred")
-        viewer.add_image(large_objects_only, name="large_objects_only")
-
-    # rotate the image parts
-    sep_x_val = int(img.shape[1] / 2)
-    if args.num_slides == 2:
-        large_objects_only = np.hstack(
-            (
-                np.rot90(large_objects_only[:, 0:sep_x_val], 2),
-                large_objects_only[:, sep_x_val:],
-            )
-        )
-
-        img = np.hstack((np.rot90(img[:, 0:sep_x_val], 2), img[:, sep_x_val:]))
-
-    large_objects_only = np.rot90(large_objects_only, 1)
-    rotated_img = np.rot90(img, 1)
-
-    if (args.with_napari) is True:
-        viewer.add_image(rotated_img, name="rotated_img")
-
-    # watershed segmentation
-    distance = ndi.distance_transform_edt(large_objects_only)
-    coords = peak_local_max(
-        distance,
-        footprint=np.ones((350, 350)),
-        labels=large_objects_only,
-        min_distance=200,
-    )
-    mask = np.zeros(distance.shape, dtype=bool)
-    mask[tuple(coords.T)] = True
-    markers, _ = ndi.label(mask)
-    labels = watershed(-distance, markers=markers, mask=large_objects_only)
-
-    # read region properties
-    props = regionprops(label_image=labels, intensity_image=rotated_img)
-    props_table = pd.DataFrame(
-        regionprops_table(
-            label_image=labels,
-            intensity_image=rotated_img,
-            properties=("label", "centroid"),
-        )
-    )
-
-    right = 0
-    left = 0
-
-    for i, p in enumerate(props):
-        section = p.image_intensity
-        section = _pad_section(section, 600)
-
-        image_basename = os.path.splitext(os.path.basename(args.image_path))[0]
-        sep_x_val = int(img.shape[1] / 2)
-
-        if args.num_slides == 2:
-            if p.centroid[0] < sep_x_val:
-                if args.num_animals == 2:
-                    fname = os.path.join(
-                        args.animal_right_name,
-                        "sections",
-                        f"{args.animal_right_name}_{str(right).zfill(3)}.tif",
-                    )
-                else:
-                    fname = os.path.join(
-                        "sections", f"{image_basename}_1_{str(right).zfill(3)}.tif"
-                    )
-                right += 1
-            else:
-                if args.num_animals == 2:
-                    fname = os.path.join(
-                        args.animal_left_name,
-                        "sections",
-                        f"{args.animal_left_name}_{str(left).zfill(3)}.tif",
-                    )
-                else:
-                    fname = os.path.join(
-                        "sections", f"{image_basename}_2_{str(left).zfill(3)}.tif"
-                    )
-                left += 1
-        else:
-            fname = os.path.join("sections", f"{image_basename}_{str(i).zfill(3)}.tif")
-
-        io.imsave(os.path.join(WORKDIR, image_basename, fname), section)
-
-        props_table.loc[i, "name"] = os.path.basename(fname).strip(".tif")
-
-    # save raw image file
-    image_basename = os.path.splitext(os.path.basename(args.image_path))[0]
-    if args.num_animals == 2:
-        left_fpath = os.path.join(
-            WORKDIR,
-            image_basename,
-            args.animal_left_name,
-            "tiff",
-            f"{image_basename}.tif",
-        )
-        io.imsave(left_fpath, img)
-
-        right_fpath = os.path.join(
-            WORKDIR,
-            image_basename,
-            args.animal_right_name,
-            "tiff",
-            f"{image_basename}.tif",
-        )
-        io.imsave(right_fpath, img)
-    else:
-        fpath = os.path.join(WORKDIR, image_basename, "tiff", f"{image_basename}.tif")
-        io.imsave(fpath, img)
-
-    if (args.with_napari) is True:
+        sections = [
+            io.imread(os.path.join(args.output_dir, i)) for i in result["sections"]
+        ]
+        viewer.add_image(np.stack(sections), name="sections")
         napari.run()
-
-    font = {"color": "black", "weight": "bold", "size": 4}
-
-    fig1, ax = plt.subplots(figsize=(10, 10), dpi=300)
-    plt.imshow(io.imread(args.image_path), cmap="Greys")
-    plt.title("Raw image")
-    ax.set_rasterized(True)
-    ax.get_xaxis().set_visible(False)
-    ax.get_yaxis().set_visible(False)
-
-    fig2, ax = plt.subplots(figsize=(10, 10), dpi=300)
-    plt.imshow(rotated_img, cmap="Greys")
-    plt.title("Rotated image")
-    ax.set_rasterized(True)
-    ax.get_xaxis().set_visible(False)
-    ax.get_yaxis().set_visible(False)
-
-    fig3, ax = plt.subplots(figsize=(10, 10), dpi=300)
-    plt.imshow(rotated_img, cmap="Greys")
-    plt.imshow(labels, cmap="rainbow", alpha=0.3 * (labels > 0))
-    plt.title("Identified slices")
-    ax.set_rasterized(True)
-    ax.get_xaxis().set_visible(False)
-    ax.get_yaxis().set_visible(False)
-
-    for index, row in props_table.iterrows():
-        plt.text(
-            row["centroid-1"],
-            row["centroid-0"],
-            row["name"],
-            ha="center",
-            va="center",
-            rotation=25,
-            fontdict=font,
-        )
-
-    pdfpath = os.path.join(WORKDIR, image_basename, "QC", "processing_QC.pdf")
-    pp = PdfPages(pdfpath)
-    pp.savefig(fig1)
-    pp.savefig(fig2)
-    pp.savefig(fig3)
-    pp.close()
-
-    # move everything to selected output dir
-    if not os.path.isdir(args.output_dir):
-        os.makedirs(args.output_dir)
-    workdir_contents = os.listdir(WORKDIR)
-    for i in workdir_contents:
-        source = os.path.join(WORKDIR, i)
-        dest = os.path.join(args.output_dir, i)
-        shutil.copytree(source, dest, dirs_exist_ok=True)
-
-    shutil.rmtree(WORKDIR)
@@ -0,0 +1,134 @@
+"""
+Quantification of the aligned section images, shared by analyze.py and
+analyze_batch.py. Pixel counts, sums, means and standard deviations of all labels are
+computed together with np.bincount, percentiles from a single sort of the pixels by
+label, instead of one boolean mask per label.
+"""
+import os
+from glob import glob
+
+import numpy as np
+from skimage import io
+from skimage.transform import rescale
+
+from modules import rasterize, regions
+
+# statistics of every region saved to results.csv next to the background subtracted
+# mean per pixel
+RESULT_STATISTICS = ("pixels", "sum", "mean", "std", "median")
+# the background is selected on the slide downscaled by this factor
+BACKGROUND_SCALE = 0.5
+
+
+def label_statistics(
+    image: np.ndarray, labels: np.ndarray, n_labels: int, percentiles=()
+) -> dict:
+    """
+    Statistics of the image pixels of labels 0 ... n_labels - 1.
+
+    Every statistic is an array of n_labels + 1 values, the last value is of all
+    labels > 0 combined. Statistics of labels without pixels are nan, except the
+    pixel count and sum. Percentiles are returned as "p<percentile>", 50 also as
+    "median".
+    """
+    labels = labels.ravel()
+    values = image.ravel().astype(np.float64)
+    assert labels.shape == values.shape, "image and labels must have the same size"
+
+    pixels = np.bincount(labels, minlength=n_labels)
+    sums = np.bincount(labels, weights=values, minlength=n_labels)
+    squares = np.bincount(labels, weights=values * values, minlength=n_labels)
+
+    pixels = np.append(pixels, pixels[1:].sum())
+    sums = np.append(sums, sums[1:].sum())
+    squares = np.append(squares, squares[1:].sum())
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / pixels
+        std = np.sqrt(np.maximum(squares / pixels - mean * mean, 0))
+
+    stats = {"pixels": pixels, "sum": sums, "mean": mean, "std": std}
+
+    if len(percentiles) > 0:
+        # after sorting by label every label is one run of pixels, and the labels > 0
+        # are the run after the background
+        order = np.argsort(labels, kind="stable")
+        sorted_values = values[order]
+        offsets = np.zeros(n_labels + 1, dtype=np.int64)
+        np.cumsum(pixels[:-1], out=offsets[1:])
+        runs = [(offsets[i], offsets[i + 1]) for i in range(n_labels)]
+        runs.append((offsets[1], offsets[-1]))
+
+        results = np.full((len(runs), len(percentiles)), np.nan)
+        for i, (start, stop) in enumerate(runs):
+            if stop > start:
+                results[i] = np.percentile(sorted_values[start:stop], percentiles)
+
+        for p, result in zip(percentiles, results.T):
+            stats[f"p{p:g}"] = result
+            if p == 50:
+                stats["median"] = result
+
+    return stats
+
+
+def find_slide_path(data_dir: str) -> str:
+    """Slide the sections in data_dir were cut from."""
+    if not os.path.isdir(os.path.join(data_dir, "..", "tiff")):
+        return glob(os.path.join(data_dir, "..", "..", "tiff", "*.tif"))[0]
+
+    return glob(os.path.join(data_dir, "..", "tiff", "*.tif"))[0]
+
+
+def load_background_image(slide_path: str) -> np.ndarray:
+    # scale down the slide to reduce size
+    image = io.imread(slide_path)
+    return rescale(image, BACKGROUND_SCALE, anti_aliasing=False, preserve_range=True)
+
+
+def background_mean(image: np.ndarray, vertices: np.ndarray) -> float:
+    """Mean of the pixels inside the background rectangle."""
+    mask = rasterize.polygon_mask([vertices], image.shape[:2])
+    return image[mask].mean()
+
+
+def roi_labels(polygons: list, names: list, shape: tuple) -> tuple:
+    """
+    Label image of the ROI polygons, every polygon is labelled with the index of its
+    name in the returned label names, where "bg" is the background.
+    """
+    label_names, name_indices = np.unique(np.asarray(names), return_inverse=True)
+    labels = rasterize.label_polygons(polygons, name_indices + 1, shape)
+
+    return ["bg"] + label_names.tolist(), labels
+
+
+def section_results(
+    image: np.ndarray, polygons: list, names: list, bg_mean: float
+) -> dict:
+    """Results of a section for every results column of the region registry."""
+    label_names, labels = roi_labels(polygons, names, image.shape[:2])
+
+    # statistics of all labels and of all ROIs combined, the last values, in one pass
+    stats = label_statistics(image, labels, len(label_names), percentiles=[50])
+
+    results_dict = {}
+    for region_name in regions.results_columns():
+        if region_name == regions.ALL_ROIS:
+            i = -1
+        elif region_name in label_names:
+            i = label_names.index(region_name)
+        else:
+            results_dict[region_name] = np.nan
+            continue
+
+        mean = stats["mean"][i]
+        area = stats["pixels"][i]
+
+        bg_subtracted_mean_per_pixel = (mean - bg_mean if mean > bg_mean else 0) / area
+        results_dict[region_name] = bg_subtracted_mean_per_pixel
+
+        for statistic in RESULT_STATISTICS:
+            results_dict[f"{region_name}_{statistic}"] = stats[statistic][i]
+
+    return results_dict
@@ -0,0 +1,92 @@
+"""
+Polygon rasterization for the ROI measurements, without a napari viewer. Polygons are
+(n, 2) arrays of row, column vertices as in napari shapes layers. A pixel belongs to a
+polygon if its center is inside (even-odd rule). Every polygon is filled with a
+scanline fill: the crossings of all edges with all pixel rows of its bounding box are
+computed at once, and the spans between pairs of crossings are filled with a
+vectorized comparison of the column indices with the span ends.
+"""
+import numpy as np
+
+
+def _polygon_spans(vertices: np.ndarray):
+    """Rows of the polygon and the first and last columns of their spans."""
+    vertices = np.asarray(vertices, dtype=np.float64)
+    y0, x0 = vertices[:, 0], vertices[:, 1]
+    y1, x1 = np.roll(y0, -1), np.roll(x0, -1)
+
+    rows = np.arange(np.ceil(y0.min()), np.floor(y0.max()) + 1)
+
+    # an edge crosses a row if the row is in [lower end, upper end), so shared
+    # vertices count once and horizontal edges never
+    crosses = (rows[:, None] >= np.minimum(y0, y1)) & (
+        rows[:, None] < np.maximum(y0, y1)
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        xs = x0 + (rows[:, None] - y0) * (x1 - x0) / (y1 - y0)
+    xs = np.where(crosses, xs, np.inf)
+    xs.sort(axis=1)
+
+    if xs.shape[1] % 2 == 1:
+        xs = np.pad(xs, ((0, 0), (0, 1)), constant_values=np.inf)
+
+    # crossings pair up into the spans inside the polygon, rows without a span have
+    # an empty one with start > stop
+    starts, stops = xs[:, 0::2], xs[:, 1::2]
+    valid = np.isfinite(stops)
+    starts = np.where(valid, np.ceil(starts), 1).astype(np.int64)
+    stops = np.where(valid, np.floor(stops), 0).astype(np.int64)
+
+    return rows.astype(np.int64), starts, stops
+
+
+def _fill_polygon(image: np.ndarray, vertices: np.ndarray, value):
+    if len(vertices) < 3:
+        return
+
+    rows, starts, stops = _polygon_spans(vertices)
+
+    # rows and spans are clipped to the image
+    height, width = image.shape[:2]
+    keep = (rows >= 0) & (rows < height)
+    rows, starts, stops = rows[keep], starts[keep], stops[keep]
+    starts = np.maximum(starts, 0)
+    stops = np.minimum(stops, width - 1)
+
+    valid = starts <= stops
+    if not valid.any():
+        return
+
+    c0, c1 = starts[valid].min(), stops[valid].max() + 1
+    cols = np.arange(c0, c1)
+
+    # one comparison of the bounding box columns per span of a row, not per pixel
+    mask = np.zeros((len(rows), len(cols)), dtype=bool)
+    for j in range(starts.shape[1]):
+        mask |= (cols >= starts[:, j, None]) & (cols <= stops[:, j, None])
+
+    image[rows[0] : rows[-1] + 1, c0:c1][mask] = value
+
+
+def polygon_mask(polygons: list, shape: tuple) -> np.ndarray:
+    """Mask of the pixels inside any of the polygons."""
+    mask = np.zeros(shape, dtype=bool)
+    for vertices in polygons:
+        _fill_polygon(mask, vertices, True)
+
+    return mask
+
+
+def label_polygons(polygons: list, labels, shape: tuple, dtype=np.int32) -> np.ndarray:
+    """
+    Label image of the polygons, labels[i] is the label of polygons[i] and the
+    background is 0. Where polygons overlap, the one listed last keeps the pixels, as
+    it is drawn on top in the viewer.
+    """
+    assert len(polygons) == len(labels), "every polygon needs a label"
+
+    label_image = np.zeros(shape, dtype=dtype)
+    for vertices, label in zip(polygons, labels):
+        _fill_polygon(label_image, vertices, label)
+
+    return label_image
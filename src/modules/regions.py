@@ -0,0 +1,55 @@
+"""
+Registry of the atlas regions shared by setup_brain_atlas.py and the analysis tool.
+Region ids are the labels of rois_atlas.tif, i + 1 for SELECTED_REGIONS[i], and 0 is
+the background. Colors are fixed so every atlas build shows the regions the same way.
+"""
+import numpy as np
+
+# results column of all ROIs combined
+ALL_ROIS = "All_ROIs"
+
+# region acronyms and their RGB colors, the order defines the region ids
+REGION_COLORS = {
+    "CB": (123, 102, 136),
+    "MY": (40, 219, 30),
+    "P": (169, 52, 6),
+    "MB": (22, 168, 42),
+    "HY": (93, 136, 135),
+    "TH": (11, 37, 100),
+    "PAL": (160, 180, 98),
+    "STR": (154, 56, 158),
+    "OLF": (86, 217, 93),
+    "Isocortex": (53, 132, 146),
+    "HIP": (28, 109, 79),
+    "RHP": (41, 102, 90),
+    "CTXsp": (53, 222, 198),
+}
+ROI_OPACITY = 0.2
+
+SELECTED_REGIONS = tuple(REGION_COLORS)
+REGION_IDS = {r: i + 1 for i, r in enumerate(SELECTED_REGIONS)}
+
+# RGBA colors in [0, 1] indexed by region id, the background is transparent
+COLORS = np.zeros((len(SELECTED_REGIONS) + 1, 4))
+COLORS[1:, :3] = np.array(list(REGION_COLORS.values())) / 255.0
+COLORS[1:, 3] = ROI_OPACITY
+
+
+def region_ids(names) -> np.ndarray:
+    return np.array([REGION_IDS[i] for i in names], dtype=int)
+
+
+def colors(names) -> np.ndarray:
+    """RGBA colors of the regions in names, one row per name."""
+    return COLORS[region_ids(names)]
+
+
+def results_columns() -> list:
+    return [ALL_ROIS] + list(SELECTED_REGIONS)
+
+
+def roi_colors_dict() -> dict:
+    # layout of roi_colors.json, {region: [id, [r, g, b, opacity]]}
+    return {
+        r: [REGION_IDS[r], [*REGION_COLORS[r], ROI_OPACITY]] for r in SELECTED_REGIONS
+    }
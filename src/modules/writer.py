@@ -0,0 +1,113 @@
+"""
+Background TIFF writer for the preprocessing outputs. Images are written by a thread
+pool while the caller goes on with the next section. Errors of the background writes
+are raised by flush(), which also waits until everything queued so far is on disk.
+"""
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+
+# lossless compression names and their tifffile names
+COMPRESSIONS = {"none": None, "deflate": "zlib", "zstd": "zstd", "lzw": "lzw"}
+# compressions that are only available with the imagecodecs package
+IMAGECODECS_COMPRESSIONS = ("zstd", "lzw")
+
+WRITE_THREADS = 4
+# images waiting to be written before write() blocks, bounds the memory of the queue
+MAX_PENDING = 32
+# tile side of tiled TIFFs
+TILE_SIZE = 512
+
+
+def check_compression(compression: str):
+    if compression not in COMPRESSIONS:
+        raise ValueError(
+            f"Unknown compression {compression}, use one of {tuple(COMPRESSIONS)}."
+        )
+
+    if compression in IMAGECODECS_COMPRESSIONS:
+        try:
+            import imagecodecs  # noqa: F401
+        except ImportError:
+            raise ImportError(
+                f"{compression} compression requires the imagecodecs package."
+            )
+
+
+def _imwrite(fpath: str, img: np.ndarray, compression: str, tiled: bool, links: list):
+    kwargs = {}
+    if COMPRESSIONS[compression] is not None:
+        kwargs["compression"] = COMPRESSIONS[compression]
+    if tiled:
+        kwargs["tile"] = (TILE_SIZE, TILE_SIZE)
+
+    tifffile.imwrite(fpath, img, **kwargs)
+
+    # other copies of the same image are hard links where the file system allows
+    for link in links:
+        try:
+            os.link(fpath, link)
+        except OSError:
+            shutil.copyfile(fpath, link)
+
+
+class TiffWriter:
+    """
+    Thread pool writing TIFF files in the background.
+
+    Use as a context manager, leaving the block waits for all writes and raises the
+    first error. Arrays passed to write() must not be modified afterwards.
+    """
+
+    def __init__(
+        self,
+        compression: str = "none",
+        num_threads: int = WRITE_THREADS,
+        max_pending: int = MAX_PENDING,
+    ):
+        check_compression(compression)
+
+        self.compression = compression
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+        self._pending = deque()
+
+    def submit(self, fn, *args, **kwargs):
+        """Run any other output task, e.g. the QC report, in the writer threads."""
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().result()
+
+        self._pending.append(self._executor.submit(fn, *args, **kwargs))
+
+    def write(self, fpath: str, img: np.ndarray, tiled: bool = False, links=()):
+        """Write img to fpath, links are further paths of the same image."""
+        self.submit(_imwrite, fpath, img, self.compression, tiled, list(links))
+
+    def flush(self):
+        """Wait for all queued writes and raise the first error."""
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+            return
+
+        # an error of the caller takes precedence over write errors
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
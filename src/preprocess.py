@@ -1,51 +1,53 @@
+import multiprocessing as mp
 import os
 import pandas as pd
+from PyQt5.QtCore import QThread, pyqtSignal
 from PyQt5.QtWidgets import QApplication, QDialog, QFileDialog
 from PyQt5.uic import loadUi
-import modules.preprocessing as preprocessing
-from modules import constants
+from modules import batch, constants
 import pyi_splash
 
 
 def _load_excel_data(data_dir: str):
     assert os.path.isdir(data_dir), "Data directory does not exist"
-    assert os.path.isfile(
-        os.path.join(data_dir, "data.xlsx")
-    ), "data.xlsx does not exist"
 
-    df = pd.read_excel(os.path.join(data_dir, "data.xlsx"))
+    return batch.load_data_table(os.path.join(data_dir, "data.xlsx"))
 
-    return df
 
+class BatchThread(QThread):
+    """Runs the batch scheduler off the GUI thread and reports per-slide events."""
 
-def _get_slide_dict(data: pd.DataFrame, input_dir: str):
-    data_dict = {
-        "image_path": os.path.join(input_dir, data["image_filename"]),
-        "num_slides": data["num_slides"],
-        "num_animals": data["num_animals"],
-        "animal_left_name": data["animal_left_name"],
-        "animal_right_name": data["animal_right_name"],
-    }
+    slide_event = pyqtSignal(str, int, str, str)
 
-    if data_dict["num_animals"] == 2:
-        left = data_dict["animal_left_name"]
-        right = data_dict["animal_right_name"]
+    def __init__(self, slides: list, output_dir: str, num_workers, memory_budget_gb):
+        super(BatchThread, self).__init__()
+        self.slides = slides
+        self.output_dir = output_dir
+        self.num_workers = num_workers
+        self.memory_budget_gb = memory_budget_gb
 
-        assert (
-            type(left) == str and len(left) > 0
-        ), f"{data_dict['image_path']} is missing animal_left_name"
-
-        assert (
-            type(right) == str and len(right) > 0
-        ), f"{data_dict['image_path']} is missing animal_right_name"
-
-    return data_dict
+    def run(self):
+        for event, index, slide, info in batch.iter_batch(
+            self.slides,
+            self.output_dir,
+            num_workers=self.num_workers,
+            memory_budget_gb=self.memory_budget_gb,
+        ):
+            if event == "finished":
+                message = f"{info['seconds']:.1f} s"
+            elif event == "failed":
+                message = info["error"]
+            else:
+                message = ""
+
+            self.slide_event.emit(event, index, slide["image_path"], message)
 
 
 class MainWindow(QDialog):
     input_dir = None
     output_dir = None
     data = None
+    batch_thread = None
 
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -57,6 +59,13 @@ class MainWindow(QDialog):
         self.run_button.clicked.connect(self.run)
         self.version_label.setText(f"Version: {constants.DIST_VERSION}")
 
+        self.num_workers_spinbox.setMaximum(mp.cpu_count())
+        self.num_workers_spinbox.setValue(batch.DEFAULT_NUM_WORKERS)
+        # the default memory limit is a share of the available memory
+        memory_budget_gb = batch.default_memory_budget_gb()
+        if memory_budget_gb is not None:
+            self.memory_budget_spinbox.setValue(round(memory_budget_gb, 1))
+
     def set_input_dir(self):
         self.input_dir = os.path.normpath(
             QFileDialog.getExistingDirectory(self, "Select Directory")
@@ -70,60 +79,60 @@ class MainWindow(QDialog):
         )
         self.output_dir_textbox.setText(self.output_dir)
 
-    def log_processing_output(self, index_str: str, image_fname: str):
-        self.log_textbox.append(
-            f"({index_str}) Preprocessing {os.path.basename(image_fname)}..."
-        )
-        QApplication.processEvents()
+    def log_slide_event(self, event: str, index: int, image_fname: str, message: str):
+        index_str = f"{index + 1} / {len(self.data)}"
+        image_fname = os.path.basename(image_fname)
+
+        if event == "started":
+            self.log_textbox.append(f"({index_str}) Preprocessing {image_fname}...")
+        elif event == "finished":
+            self.log_textbox.append(f"({index_str}) Finished {image_fname} ({message})")
+        elif event == "failed":
+            self.log_textbox.append(f"({index_str}) FAILED {image_fname}: {message}")
 
     def log_finished_output(self):
         self.log_textbox.append("")
         self.log_textbox.append("PREPROCESSING COMPLETE.")
         self.log_textbox.append("")
 
+    def set_controls_enabled(self, enabled: bool):
+        self.run_button.setEnabled(enabled)
+        self.select_source_dir_button.setEnabled(enabled)
+        self.select_output_directory.setEnabled(enabled)
+        self.num_workers_spinbox.setEnabled(enabled)
+        self.memory_budget_spinbox.setEnabled(enabled)
+
+    def batch_finished(self):
+        self.log_finished_output()
+        self.set_controls_enabled(True)
+
     def run(self):
-        self.run_button.setEnabled(False)
-        self.select_source_dir_button.setEnabled(False)
-        self.select_output_directory.setEnabled(False)
         assert self.data is not None, "Data not loaded."
         assert type(self.data) == pd.DataFrame, "Data is not a pandas DataFrame."
 
-        # script_path = os.path.join(
-        #     os.path.dirname(__file__), "modules", "preprocessing.py"
-        # )
-        num_files = len(self.data)
-
-        # loop through dataframe and run processing
-        for index, row in self.data.iterrows():
-            data = _get_slide_dict(data=row, input_dir=self.input_dir)
-
-            self.log_processing_output(f"{index + 1} / {num_files}", data["image_path"])
-
-            if data["num_animals"] == 2:
-                preprocessing.run(
-                    image_path=data["image_path"],
-                    num_slides=data["num_slides"],
-                    num_animals=data["num_animals"],
-                    animal_left_name=data["animal_left_name"],
-                    animal_right_name=data["animal_right_name"],
-                    output_dir=self.output_dir,
-                )
-
-            if data["num_animals"] == 1:
-                preprocessing.run(
-                    image_path=data["image_path"],
-                    num_slides=data["num_slides"],
-                    num_animals=data["num_animals"],
-                    output_dir=self.output_dir,
-                )
+        slides = [
+            batch.get_slide_dict(data=row, input_dir=self.input_dir)
+            for _, row in self.data.iterrows()
+        ]
 
-        self.log_finished_output()
-        self.run_button.setEnabled(True)
-        self.select_source_dir_button.setEnabled(True)
-        self.select_output_directory.setEnabled(True)
+        self.set_controls_enabled(False)
+
+        # a budget of 0 GB means no limit
+        self.batch_thread = BatchThread(
+            slides,
+            self.output_dir,
+            num_workers=self.num_workers_spinbox.value(),
+            memory_budget_gb=self.memory_budget_spinbox.value(),
+        )
+        self.batch_thread.slide_event.connect(self.log_slide_event)
+        self.batch_thread.finished.connect(self.batch_finished)
+        self.batch_thread.start()
 
 
 if __name__ == "__main__":
+    # required for the worker processes of the frozen executable
+    mp.freeze_support()
+
     app = QApplication([])
     window = MainWindow()
     window.show()
@@ -3,7 +3,7 @@ from PyInstaller.utils.hooks import collect_all
 
 datas = [("gui", "gui")]
 binaries = []
-hiddenimports = ["openpyxl"]
+hiddenimports = ["openpyxl", "psutil"]
 tmp_ret = collect_all("openpyxl")
 datas += tmp_ret[0]
 binaries += tmp_ret[1]
@@ -0,0 +1,225 @@
+"""
+MODULE: Headless batch preprocessing
+
+Command-line version of the preprocessing module for machines without a display.
+All slides listed in data.xlsx (or a CSV file with the same columns) are preprocessed
+in parallel with the same code as the GUI. A JSON manifest with per-slide timings,
+section counts and errors is written to the output directory and updated after
+every slide.
+
+Example:
+    python preprocess_cli.py --input-dir images/ --output-dir preprocessed/ --workers 8
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+from datetime import datetime
+
+from modules import batch, constants, files, preprocessing, writer
+
+
+def _write_manifest(manifest: dict, manifest_path: str):
+    with files.atomic_open(manifest_path) as f:
+        json.dump(manifest, f, indent=2)
+
+
+def _slide_entry(row: int, slide: dict) -> dict:
+    return {
+        # row of the slide in the data table, starting from 0
+        "row": row,
+        "image_filename": os.path.basename(slide["image_path"]),
+        "status": "pending",
+        "seconds": None,
+        "num_sections": None,
+        "sections": [],
+        "error": None,
+    }
+
+
+def run_batch(
+    data_path: str,
+    input_dir: str,
+    output_dir: str,
+    manifest_path: str,
+    num_workers: int = None,
+    memory_budget_gb: float = None,
+    options: dict = None,
+) -> dict:
+    data = batch.load_data_table(data_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if memory_budget_gb is None:
+        memory_budget_gb = batch.default_memory_budget_gb()
+
+    manifest = {
+        "version": constants.DIST_VERSION,
+        "data_path": os.path.abspath(data_path),
+        "input_dir": os.path.abspath(input_dir),
+        "output_dir": os.path.abspath(output_dir),
+        "num_workers": num_workers or batch.DEFAULT_NUM_WORKERS,
+        "memory_budget_gb": memory_budget_gb,
+        "options": options or {},
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "finished": None,
+        "seconds": None,
+        "slides": [],
+    }
+
+    # invalid rows are recorded as failed instead of stopping the whole batch, the
+    # manifest keeps the order of the data table
+    slides = []
+    entries = []
+    for i, (_, row) in enumerate(data.iterrows()):
+        try:
+            slide = batch.get_slide_dict(data=row, input_dir=input_dir)
+        except (AssertionError, KeyError, TypeError) as e:
+            entry = _slide_entry(i, {"image_path": str(row.get("image_filename"))})
+            entry.update({"status": "failed", "error": f"Invalid row: {e}"})
+            manifest["slides"].append(entry)
+            continue
+
+        slides.append(slide)
+        entries.append(_slide_entry(i, slide))
+        manifest["slides"].append(entries[-1])
+
+    _write_manifest(manifest, manifest_path)
+
+    start_time = time.perf_counter()
+    for event, index, slide, info in batch.iter_batch(
+        slides,
+        output_dir,
+        num_workers=num_workers,
+        memory_budget_gb=memory_budget_gb,
+        options=options,
+    ):
+        entry = entries[index]
+        progress = f"({index + 1} / {len(slides)})"
+
+        if event == "started":
+            entry["status"] = "running"
+            print(f"{progress} Preprocessing {entry['image_filename']}...")
+            continue
+
+        entry["seconds"] = info["seconds"]
+        if event == "finished":
+            entry["status"] = "finished"
+            entry["num_sections"] = info["result"]["num_sections"]
+            entry["sections"] = info["result"]["sections"]
+            print(f"{progress} Finished {entry['image_filename']}")
+        else:
+            entry["status"] = "failed"
+            entry["error"] = info["error"]
+            entry["traceback"] = info.get("traceback")
+            print(f"{progress} FAILED {entry['image_filename']}: {info['error']}")
+
+        _write_manifest(manifest, manifest_path)
+
+    manifest["finished"] = datetime.now().isoformat(timespec="seconds")
+    manifest["seconds"] = time.perf_counter() - start_time
+    _write_manifest(manifest, manifest_path)
+
+    return manifest
+
+
+if __name__ == "__main__":
+    mp.freeze_support()
+
+    parser = argparse.ArgumentParser(description="Preprocess TIFF ARG images.")
+    parser.add_argument(
+        "--input-dir", type=str, help="Folder with the TIFF images", required=True
+    )
+    parser.add_argument(
+        "--output-dir", type=str, help="Output directory", required=True
+    )
+    parser.add_argument(
+        "--data",
+        type=str,
+        help="data.xlsx or CSV file describing the slides "
+        "(default: data.xlsx in the input directory)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=batch.DEFAULT_NUM_WORKERS,
+        help="Number of slides processed in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=float,
+        help="Memory limit in GB for slides running in parallel "
+        "(default: 80%% of the available memory, 0 for no limit)",
+    )
+    parser.add_argument(
+        "--mask-downsample",
+        type=int,
+        default=preprocessing.MASK_DOWNSAMPLE,
+        help="Downsampling factor of an approximate tissue mask (default: 4), 1 "
+        "computes the exact mask at full resolution",
+    )
+    parser.add_argument(
+        "--separation",
+        type=str,
+        choices=preprocessing.SEPARATION_METHODS,
+        default="components",
+        help="Method used to split the tissue mask into sections, watershed is the "
+        "reference and components is faster",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Memory-map the slides and keep intermediate images on disk",
+    )
+    parser.add_argument(
+        "--qc",
+        type=str,
+        choices=preprocessing.QC_FORMATS,
+        default="pdf",
+        help="Format of the QC reports, none skips them",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=tuple(writer.COMPRESSIONS),
+        default="none",
+        help="Lossless compression of the output TIFFs, zstd and lzw require the "
+        "imagecodecs package",
+    )
+    parser.add_argument(
+        "--tiled", action="store_true", help="Write the full slides as tiled TIFFs"
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        help="Path of the JSON run manifest (default: manifest.json in the output "
+        "directory)",
+    )
+
+    args = parser.parse_args()
+
+    data_path = args.data or os.path.join(args.input_dir, "data.xlsx")
+    manifest_path = args.manifest or os.path.join(args.output_dir, "manifest.json")
+
+    manifest = run_batch(
+        data_path=data_path,
+        input_dir=args.input_dir,
+        output_dir=args.output_dir,
+        manifest_path=manifest_path,
+        num_workers=args.workers,
+        memory_budget_gb=args.memory_limit,
+        options={
+            "mask_downsample": args.mask_downsample,
+            "separation": args.separation,
+            "low_memory": args.low_memory,
+            "qc": args.qc,
+            "compression": args.compression,
+            "tiled": args.tiled,
+        },
+    )
+
+    num_failed = sum(1 for i in manifest["slides"] if i["status"] == "failed")
+    print(f"PREPROCESSING COMPLETE. {num_failed} slide(s) failed.")
+    sys.exit(1 if num_failed > 0 else 0)
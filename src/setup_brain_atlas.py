@@ -2,9 +2,15 @@
 MODULE: Brain atlas setup
 
 This module extracts the brain atlas from the brain atlas API and saves it as a TIFF. 
-ROIs from selected brain regions are saved in a TIFF stack using randomly selected
-colors, and then converted to multipolygons and saved to a JSON dictionary. 
-The atlas and related files are stored in the brain_atlas_files folder.
+ROIs from selected brain regions are saved in a TIFF stack, with the fixed colors of
+the region registry in modules/regions.py, and then converted to multipolygons and
+saved to a JSON dictionary. 
+Polygons and slice centroids are also saved in atlas_bundle.npz, which is
+what the analysis tool loads.
+The atlas and related files are stored in the brain_atlas_files folder, atlases other
+than the default one in a subfolder named after the atlas. Scale and padding are
+derived from the atlas resolution and the pixel size of the preprocessed sections and
+saved in atlas_metadata.json.
 
 Original code from Zuzana Čočková, modified by Junel Solis.
 Turku PET Centre, University of Turku, Finland
@@ -12,163 +18,449 @@ Turku BioImaging, University of Turku and Åbo Akademi University, Finland
 """
 
 import argparse
+import hashlib
 import json
 import multiprocessing as mp
 import os
-import random
+import shutil
+from datetime import datetime
 
 import numpy as np
 import pandas as pd
 import shapely
+import tifffile
 from bg_atlasapi import BrainGlobeAtlas as bga
 from rasterio import Affine, features
 from scipy import ndimage as ndi
-from skimage import io
-from skimage.measure import label, regionprops
 from skimage.morphology import remove_small_objects
 from skimage.transform import rescale
 from tqdm import tqdm
 
+from modules import atlas_bundle, constants, files
+from modules.regions import SELECTED_REGIONS, roi_colors_dict
+
 ATLAS_PATH = os.path.join(os.path.dirname(__file__), "brain_atlas_files")
-SELECTED_ATLAS = "allen_mouse_100um"
-SELECTED_REGIONS = (
-    "CB",
-    "MY",
-    "P",
-    "MB",
-    "HY",
-    "TH",
-    "PAL",
-    "STR",
-    "OLF",
-    "Isocortex",
-    "HIP",
-    "RHP",
-    "CTXsp",
+# pixel size in um and side length of the preprocessed sections the atlas is matched to
+SECTION_PIXEL_SIZE = 25
+SECTION_SIZE = 600
+SIMPLIFY_TOLERANCE = 4
+# increased on every change of how the atlas stacks are stored
+ATLAS_STACK_VERSION = 2
+SLICE_CENTROID_COLUMNS = (
+    "slice",
+    "centroid_y",
+    "centroid_x",
+    "area",
+    "bbox_min_y",
+    "bbox_min_x",
+    "bbox_max_y",
+    "bbox_max_x",
 )
-PAD_WIDTHS = ((0, 0), (140, 140), (72, 72))
 
+# the build manifest records the parameters each atlas file was built from, files are
+# rebuilt when their parameters change
+BUILD_MANIFEST = "atlas_build.json"
+CACHE_DIR = ".cache"
+# files shipped with the repository, adopted as current if they were built before the
+# build manifest existed. they are only adopted for the atlas and geometry they were
+# built with
+SHIPPED_FILES = ("roi_colors.json", "roi_shapes.json")
+SHIPPED_ATLAS = constants.DEFAULT_ATLAS
+SHIPPED_GEOMETRY = {
+    "pixel_size": 25,
+    "scale": 4,
+    "pad_widths": ((0, 0), (140, 140), (72, 72)),
+    "section_size": 600,
+}
+
+# scale and padding in the pool workers, set once per worker by _init_worker
+_geometry = {}
+
+
+def _get_geometry(bg_atlas: bga, pixel_size: float, section_size: int) -> dict:
+    # atlas planes are upscaled to the pixel size of the sections and padded to
+    # section_size, e.g. 100 um atlas pixels are repeated 4 times for 25 um sections
+    resolution = bg_atlas.metadata["resolution"]
+    assert resolution[1] == resolution[2], "Atlas planes must have square pixels"
+
+    scale = resolution[1] / pixel_size
+    if float(scale).is_integer():
+        scale = int(scale)
+
+    pad_widths = [(0, 0)]
+    for n in bg_atlas.metadata["shape"][1:]:
+        pad = section_size - int(round(n * scale))
+        assert pad >= 0, (
+            f"Atlas planes of {n} pixels do not fit into {section_size} pixel "
+            f"sections at {pixel_size} um"
+        )
+        pad_widths.append((pad // 2, pad - pad // 2))
 
-def _check_files():
-    if not os.path.isfile(os.path.join(ATLAS_PATH, "roi_colors.json")):
-        return False
+    return {
+        "pixel_size": pixel_size,
+        "scale": scale,
+        "pad_widths": tuple(pad_widths),
+        "section_size": section_size,
+    }
 
-    if not os.path.isfile(os.path.join(ATLAS_PATH, "slice_centroids.csv")):
-        return False
 
-    if not os.path.isfile(os.path.join(ATLAS_PATH, "roi_shapes.json")):
-        return False
+def _upscale_plane(plane: np.ndarray, geometry: dict, order: int = 0) -> np.ndarray:
+    # nearest neighbour upscaling by an integer factor is a repeat of every pixel
+    scale = geometry["scale"]
+    if order == 0 and isinstance(scale, int):
+        plane = plane.repeat(scale, axis=0).repeat(scale, axis=1)
+    elif order == 0:
+        plane = rescale(
+            plane, scale, order=0, preserve_range=True, anti_aliasing=False
+        ).astype(plane.dtype)
+    else:
+        plane = rescale(
+            plane, scale, order=order, preserve_range=True, anti_aliasing=True
+        )
 
-    print("All text data files found.")
-    return True
+    return np.pad(plane, pad_width=geometry["pad_widths"][1:])
 
 
-def _check_tiff_files():
-    if not os.path.isfile(os.path.join(ATLAS_PATH, "anatomical_atlas.tif")):
-        return False
+def _params_key(params: dict) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _write_json(data, json_path: str):
+    with files.atomic_open(json_path) as f:
+        json.dump(data, f)
+
+
+def _build_params(bg_atlas: bga, atlas_name: str, geometry: dict) -> dict:
+    # parameters of every atlas file, json round-tripped so they compare equal to
+    # the ones read back from the manifest
+    atlas = {
+        "atlas": atlas_name,
+        "atlas_version": str(bg_atlas.metadata.get("version")),
+        "scale": geometry["scale"],
+        "pad_widths": geometry["pad_widths"],
+    }
+    stacks = {**atlas, "stack_version": ATLAS_STACK_VERSION}
+    params = {
+        "anatomical_atlas.tif": stacks,
+        "rois_atlas.tif": {**stacks, "regions": SELECTED_REGIONS},
+        "roi_colors.json": roi_colors_dict(),
+        "roi_shapes.json": {
+            **atlas,
+            "regions": SELECTED_REGIONS,
+            "simplify_tolerance": SIMPLIFY_TOLERANCE,
+        },
+        "slice_centroids.csv": {**atlas, "columns": SLICE_CENTROID_COLUMNS},
+    }
+    # the bundle is converted from the other files and rebuilt whenever they are
+    params[atlas_bundle.BUNDLE_FILE] = {
+        "version": atlas_bundle.BUNDLE_VERSION,
+        "simplification_levels": atlas_bundle.SIMPLIFICATION_LEVELS,
+        "sources": {i: _params_key(params[i]) for i in atlas_bundle.SOURCE_FILES},
+    }
 
-    if not os.path.isfile(os.path.join(ATLAS_PATH, "rois_atlas.tif")):
+    return json.loads(json.dumps(params))
+
+
+def _load_build_manifest(atlas_dir: str) -> dict:
+    manifest_path = os.path.join(atlas_dir, BUILD_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return {"files": {}}
+
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _record_build(
+    atlas_dir: str, manifest: dict, fname: str, params: dict, adopted: bool = False
+):
+    manifest["files"][fname] = {
+        "key": _params_key(params),
+        "params": params,
+        "built": datetime.now().isoformat(timespec="seconds"),
+        "adopted": adopted,
+    }
+    _write_json(manifest, os.path.join(atlas_dir, BUILD_MANIFEST))
+
+
+def _is_current(atlas_dir: str, manifest: dict, fname: str, params: dict) -> bool:
+    if not os.path.isfile(os.path.join(atlas_dir, fname)):
         return False
 
-    print("Atlas TIFFs found.")
-    return True
+    entry = manifest["files"].get(fname)
+    return entry is not None and entry["key"] == _params_key(params)
 
 
-def _save_rois_to_tiff(n_slices: int, bg_atlas: bga):
-    # get regions of interest
-    rois = np.empty((n_slices, 600, 600))
-    for reg in SELECTED_REGIONS:
-        mask_t = bg_atlas.get_structure_mask(reg)
-        mask_t = np.pad(
-            (rescale(mask_t, (1, 4, 4), anti_aliasing=True, order=0)),
-            pad_width=PAD_WIDTHS,
-        )
+def _region_shapes_path(atlas_dir: str, region: str, params: dict) -> str:
+    # polygons of one region are cached per region, so adding a region only
+    # computes the new one
+    region_params = {k: v for k, v in params.items() if k != "regions"}
+    key = _params_key({**region_params, "region": region})
+    return os.path.join(atlas_dir, CACHE_DIR, "roi_shapes", f"{region}_{key}.json")
+
 
-        # not binary anymore
-        rois += mask_t
-        # care for overlaping rois
+def _is_shipped_geometry(atlas_name: str, geometry: dict) -> bool:
+    # compared json round-tripped, tuples are read back as lists
+    return atlas_name == SHIPPED_ATLAS and json.loads(
+        json.dumps(geometry)
+    ) == json.loads(json.dumps(SHIPPED_GEOMETRY))
 
-    io.imsave(os.path.join(ATLAS_PATH, "rois_atlas.tif"), rois, check_contrast=False)
+
+def _drop_adopted_files(atlas_dir: str, manifest: dict):
+    # files adopted by earlier versions whatever the geometry are rebuilt. region
+    # shapes cached from a roi_shapes.json adopted under another geometry are
+    # removed, they would otherwise be reused for the rebuild
+    shipped_params = {
+        "atlas": SHIPPED_ATLAS,
+        "scale": SHIPPED_GEOMETRY["scale"],
+        "pad_widths": SHIPPED_GEOMETRY["pad_widths"],
+    }
+    shipped_params = json.loads(json.dumps(shipped_params))
+
+    for fname, entry in list(manifest["files"].items()):
+        if not entry.get("adopted", False):
+            continue
+
+        params = entry["params"]
+        if fname == "roi_shapes.json" and any(
+            params.get(k) != v for k, v in shipped_params.items()
+        ):
+            for region in params["regions"]:
+                region_shapes_path = _region_shapes_path(atlas_dir, region, params)
+                if os.path.isfile(region_shapes_path):
+                    os.remove(region_shapes_path)
+
+        del manifest["files"][fname]
+
+
+def _adopt_shipped_files(atlas_dir: str, manifest: dict, params: dict):
+    for fname in SHIPPED_FILES:
+        if fname in manifest["files"]:
+            continue
+        if not os.path.isfile(os.path.join(atlas_dir, fname)):
+            continue
+
+        if fname == "roi_shapes.json":
+            with open(os.path.join(atlas_dir, fname)) as f:
+                slice_region_dict = json.load(f)
+
+            os.makedirs(os.path.join(atlas_dir, CACHE_DIR, "roi_shapes"), exist_ok=True)
+            for region in SELECTED_REGIONS:
+                _write_json(
+                    {s: regions[region] for s, regions in slice_region_dict.items()},
+                    _region_shapes_path(atlas_dir, region, params[fname]),
+                )
+
+        _record_build(atlas_dir, manifest, fname, params[fname], adopted=True)
+
+
+def _save_metadata(atlas_dir: str, bg_atlas: bga, atlas_name: str, geometry: dict):
+    metadata = {
+        "atlas": atlas_name,
+        "atlas_version": bg_atlas.metadata.get("version"),
+        "species": bg_atlas.metadata.get("species"),
+        "resolution_um": bg_atlas.metadata["resolution"],
+        "section_pixel_size_um": geometry["pixel_size"],
+        "section_size": geometry["section_size"],
+        "scale": geometry["scale"],
+        "pad_widths": geometry["pad_widths"],
+        "n_slices": bg_atlas.metadata["shape"][0],
+        "regions": SELECTED_REGIONS,
+        "contrast_limits": _load_metadata(atlas_dir).get("contrast_limits", {}),
+    }
+    _write_json(metadata, os.path.join(atlas_dir, "atlas_metadata.json"))
 
 
-def _save_slice_centroids(bg_atlas: bga, n_slices: int):
-    # atlas slices centroids
-    brain_mask = bg_atlas.get_structure_mask(8)  # dtype np.uint32
+def _load_metadata(atlas_dir: str) -> dict:
+    metadata_path = os.path.join(atlas_dir, "atlas_metadata.json")
+    if not os.path.isfile(metadata_path):
+        return {}
 
-    # brain_mask = brain_mask / brain_mask.max()
-    brain_mask = np.pad(
-        (rescale(brain_mask, (1, 4, 4), anti_aliasing=True, order=0)),
-        pad_width=PAD_WIDTHS,
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+def _save_contrast_limits(atlas_dir: str, fname: str, contrast_limits: list):
+    # contrast limits of the atlas stacks are stored so analyze.py does not have to
+    # read the whole stacks to compute them
+    metadata = _load_metadata(atlas_dir)
+    metadata.setdefault("contrast_limits", {})[fname] = contrast_limits
+    _write_json(metadata, os.path.join(atlas_dir, "atlas_metadata.json"))
+
+
+def _create_stack(atlas_dir: str, fname: str, n_slices: int, size: int, dtype):
+    # uncompressed TIFF that analyze.py can memory-map
+    return tifffile.memmap(
+        os.path.join(atlas_dir, fname), shape=(n_slices, size, size), dtype=dtype
     )
 
-    filled_brain_mask = ndi.binary_dilation(brain_mask)
 
-    for i in range(n_slices):
-        filled_brain_mask[i] = ndi.binary_fill_holes(filled_brain_mask[i])
+def _init_worker(geometry: dict):
+    global _geometry
+    _geometry = geometry
 
-    filled_brain_mask = ndi.binary_erosion(filled_brain_mask)
-    slice_centroids = []
-    for i in range(n_slices):
-        props_atlas = regionprops(label(brain_mask[i]))
-        if len(props_atlas) > 0:
-            center_of_mass = props_atlas[0].centroid
-
-            slice_centroids.append(
-                {
-                    "slice": i,
-                    "centroid_y": center_of_mass[0],
-                    "centroid_x": center_of_mass[1],
-                }
-            )
 
-    df = pd.DataFrame(slice_centroids)
-    df.to_csv(os.path.join(ATLAS_PATH, "slice_centroids.csv"), index=False)
+def _save_anatomical_atlas(atlas_dir: str, bg_atlas: bga, geometry: dict):
+    # planes are rescaled one at a time into a memory-mapped TIFF, which gives the
+    # same stack as rescaling the whole volume. intensities keep the range of the
+    # atlas reference and are rounded to uint16
+    n_slices = bg_atlas.metadata["shape"][0]
+    anatomical_stack_rs = _create_stack(
+        atlas_dir,
+        "anatomical_atlas.tif",
+        n_slices,
+        geometry["section_size"],
+        np.uint16,
+    )
 
+    max_value = 0
+    for i in range(n_slices):
+        plane = _upscale_plane(bg_atlas.reference[i], geometry, order=1)
+        anatomical_stack_rs[i] = np.clip(np.rint(plane), 0, np.iinfo(np.uint16).max)
+        max_value = max(max_value, int(anatomical_stack_rs[i].max()))
 
-def _save_roi_shapes(n_slices: int):
-    print("Converting atlas ROIs to polygons...")
-    with mp.Pool(mp.cpu_count()) as pool:
-        slice_region_dict = {}
+    anatomical_stack_rs.flush()
+    del anatomical_stack_rs
 
-        for slice in tqdm(range(n_slices)):
-            region_dict = {}
+    _save_contrast_limits(atlas_dir, "anatomical_atlas.tif", [0, max_value])
 
-            async_results = [
-                pool.apply_async(
-                    _convert_slice_region_to_multipolygons, args=(slice, r)
-                )
-                for r in SELECTED_REGIONS
-            ]
 
-            results = [arg.get() for arg in async_results]
+def _build_roi_labels(bg_atlas: bga) -> np.ndarray:
+    # label i + 1 marks SELECTED_REGIONS[i] like in roi_colors.json, where regions
+    # overlap the region listed first keeps the voxel
+    dtype = np.uint8 if len(SELECTED_REGIONS) < 256 else np.uint16
+    labels = np.zeros(bg_atlas.metadata["shape"], dtype=dtype)
 
-            for i in results:
-                region_dict[i["region"]] = i["polygons_list"]
+    # region masks are read one at a time to keep memory bounded for fine atlases
+    for i in reversed(range(len(SELECTED_REGIONS))):
+        labels[bg_atlas.get_structure_mask(SELECTED_REGIONS[i]) > 0] = i + 1
 
-            slice_region_dict[slice] = region_dict
+    return labels
 
-        with open(os.path.join(ATLAS_PATH, "roi_shapes.json"), "w") as f:
-            json.dump(slice_region_dict, f)
 
+def _save_rois_to_tiff(atlas_dir: str, bg_atlas: bga, geometry: dict):
+    labels = _build_roi_labels(bg_atlas)
 
-def _assign_region_colors():
-    list_colors = []
-    n = len(SELECTED_REGIONS)
+    rois = _create_stack(
+        atlas_dir,
+        "rois_atlas.tif",
+        labels.shape[0],
+        geometry["section_size"],
+        labels.dtype,
+    )
+    for i in range(labels.shape[0]):
+        rois[i] = _upscale_plane(labels[i], geometry)
+
+    rois.flush()
+    del rois
+
+    _save_contrast_limits(atlas_dir, "rois_atlas.tif", [0, int(labels.max())])
+
+
+def _save_slice_centroids(atlas_dir: str, bg_atlas: bga, geometry: dict):
+    # centroid, area and bounding box of the brain mask of every slice, computed at
+    # atlas resolution and mapped to section pixels. a pixel repeated scale times
+    # covers scale * i ... scale * i + scale - 1, centered on scale * i + offset
+    brain_mask = bg_atlas.get_structure_mask(8) > 0
+    scale = geometry["scale"]
+    offset = (scale - 1) / 2
+    pad_y, pad_x = geometry["pad_widths"][1][0], geometry["pad_widths"][2][0]
+
+    rows = brain_mask.any(axis=2)
+    cols = brain_mask.any(axis=1)
+    area = np.count_nonzero(brain_mask, axis=(1, 2))
+    slices = np.flatnonzero(area)
+
+    row_counts = np.count_nonzero(brain_mask, axis=2)[slices]
+    col_counts = np.count_nonzero(brain_mask, axis=1)[slices]
+    centroid_y = row_counts @ np.arange(rows.shape[1]) / area[slices]
+    centroid_x = col_counts @ np.arange(cols.shape[1]) / area[slices]
+
+    rows = rows[slices]
+    cols = cols[slices]
+    min_y = rows.argmax(axis=1)
+    max_y = rows.shape[1] - rows[:, ::-1].argmax(axis=1)
+    min_x = cols.argmax(axis=1)
+    max_x = cols.shape[1] - cols[:, ::-1].argmax(axis=1)
+
+    # bounding boxes follow regionprops, max_y and max_x are exclusive
+    df = pd.DataFrame(
+        {
+            "slice": slices,
+            "centroid_y": scale * centroid_y + offset + pad_y,
+            "centroid_x": scale * centroid_x + offset + pad_x,
+            "area": area[slices] * scale**2,
+            "bbox_min_y": np.round(scale * min_y).astype(int) + pad_y,
+            "bbox_min_x": np.round(scale * min_x).astype(int) + pad_x,
+            "bbox_max_y": np.round(scale * max_y).astype(int) + pad_y,
+            "bbox_max_x": np.round(scale * max_x).astype(int) + pad_x,
+        }
+    )
+    df.to_csv(os.path.join(atlas_dir, "slice_centroids.csv"), index=False)
 
-    for _ in range(n):
-        r = random.randint(0, 255)
-        g = random.randint(0, 255)
-        b = random.randint(0, 255)
-        rgba = [r, g, b, 0.2]
-        list_colors.append(rgba)
 
-    roi_colors_dict = {
-        SELECTED_REGIONS[a]: [a + 1, list_colors[a]]
-        for a, _ in enumerate(SELECTED_REGIONS)
+def _save_roi_shapes(atlas_dir: str, bg_atlas: bga, geometry: dict, params: dict):
+    print("Converting atlas ROIs to polygons...")
+    n_slices = bg_atlas.metadata["shape"][0]
+
+    regions = [
+        r
+        for r in SELECTED_REGIONS
+        if not os.path.isfile(_region_shapes_path(atlas_dir, r, params))
+    ]
+    if len(regions) > 0:
+        _save_region_shapes(atlas_dir, bg_atlas, geometry, regions, params)
+
+    region_shapes = {}
+    for region in SELECTED_REGIONS:
+        with open(_region_shapes_path(atlas_dir, region, params)) as f:
+            region_shapes[region] = json.load(f)
+
+    slice_region_dict = {
+        str(slice): {r: region_shapes[r][str(slice)] for r in SELECTED_REGIONS}
+        for slice in range(n_slices)
     }
+    _write_json(slice_region_dict, os.path.join(atlas_dir, "roi_shapes.json"))
+
+
+def _region_tasks(bg_atlas: bga, regions: list):
+    # each region mask is read from the atlas once, tasks carry single planes so only
+    # the region currently submitted is held in memory
+    for r in regions:
+        region_mask = bg_atlas.get_structure_mask(r) > 0
+        for slice in range(region_mask.shape[0]):
+            yield slice, r, region_mask[slice]
+
+
+def _save_region_shapes(
+    atlas_dir: str, bg_atlas: bga, geometry: dict, regions: list, params: dict
+):
+    os.makedirs(os.path.join(atlas_dir, CACHE_DIR, "roi_shapes"), exist_ok=True)
+    n_slices = bg_atlas.metadata["shape"][0]
+
+    with mp.Pool(
+        mp.cpu_count(), initializer=_init_worker, initargs=(geometry,)
+    ) as pool:
+        # each region is written to the cache as soon as all of its slices are done
+        region_slice_dict = {}
+
+        for i in tqdm(
+            pool.imap_unordered(_convert_task, _region_tasks(bg_atlas, regions)),
+            total=n_slices * len(regions),
+        ):
+            slice_dict = region_slice_dict.setdefault(i["region"], {})
+            slice_dict[i["slice"]] = i["polygons_list"]
+
+            if len(slice_dict) == n_slices:
+                _write_json(
+                    {str(s): slice_dict[s] for s in range(n_slices)},
+                    _region_shapes_path(atlas_dir, i["region"], params),
+                )
+                del region_slice_dict[i["region"]]
 
-    with open(os.path.join(ATLAS_PATH, "roi_colors.json"), "w") as f:
-        json.dump(roi_colors_dict, f)
+
+def _assign_region_colors(atlas_dir: str):
+    # colors are fixed in the region registry, so rebuilds keep them
+    _write_json(roi_colors_dict(), os.path.join(atlas_dir, "roi_colors.json"))
 
 
 def _convert_to_multipolygon(mask: np.ndarray):
@@ -192,37 +484,29 @@ def _convert_to_multipolygon(mask: np.ndarray):
     # simplify the polygons to reduce vertices
     simplified_polygons = []
     for poly in polygons:
-        simplified_polygons.append(poly.simplify(tolerance=4))
+        simplified_polygons.append(poly.simplify(tolerance=SIMPLIFY_TOLERANCE))
 
     multi_polygon = shapely.geometry.MultiPolygon(simplified_polygons)
     return multi_polygon
 
 
-def _shapely_shaper(region, slice):
-    roi_t = bga(SELECTED_ATLAS).get_structure_mask(region)
-
-    slice_t = roi_t[slice]
-
-    slice_t = slice_t > 0
+def _shapely_shaper(region, slice_t):
     slice_t = ndi.binary_fill_holes(slice_t).astype(slice_t.dtype)
     slice_t = remove_small_objects(slice_t)
     slice_t = ndi.binary_erosion(slice_t).astype(slice_t.dtype)
-    slice_t = np.pad(
-        (rescale(slice_t, (4, 4), anti_aliasing=False, order=0)),
-        pad_width=((140, 140), (72, 72)),
-    )
+    slice_t = _upscale_plane(slice_t, _geometry)
 
     if region == "Isocortex":
         # split isocortex shape in half
-        slice_t[:, 300] = 0
+        slice_t[:, _geometry["section_size"] // 2] = 0
 
     polygon = _convert_to_multipolygon(slice_t)
 
     return polygon
 
 
-def _convert_slice_region_to_multipolygons(slice: int, region: str):
-    region_polygon = _shapely_shaper(region, slice)
+def _convert_slice_region_to_multipolygons(slice: int, region: str, mask: np.ndarray):
+    region_polygon = _shapely_shaper(region, mask)
 
     polygons_list = []
 
@@ -237,52 +521,94 @@ def _convert_slice_region_to_multipolygons(slice: int, region: str):
                 ).tolist()
             )
 
-    print({"region": region, "polygons_list": polygons_list})
-    return {"region": region, "polygons_list": polygons_list}
+    return {"slice": slice, "region": region, "polygons_list": polygons_list}
 
 
-def _prepare_atlas():
-    bg_atlas = bga(SELECTED_ATLAS)
+def _convert_task(task: tuple):
+    return _convert_slice_region_to_multipolygons(*task)
 
-    # anatomical atlas
-    anatomical_stack = bg_atlas.reference
-    n_slices = anatomical_stack.shape[0]
 
-    anatomical_stack_rs = np.pad(
-        (rescale(anatomical_stack, (1, 4, 4), anti_aliasing=True)),
-        pad_width=((0, 0), (140, 140), (72, 72)),
-    )
-
-    # to match 600,600 xy-shape and pixel size of images, values might be
-    # different for other atlases
+def _prepare_atlas(
+    atlas_name: str,
+    pixel_size: float = SECTION_PIXEL_SIZE,
+    section_size: int = SECTION_SIZE,
+    force: bool = False,
+):
+    bg_atlas = bga(atlas_name)
+    atlas_dir = constants.get_atlas_dir(ATLAS_PATH, atlas_name)
+    os.makedirs(atlas_dir, exist_ok=True)
 
-    if args.force_download is True or _check_tiff_files() is False:
-        io.imsave(
-            os.path.join(ATLAS_PATH, "anatomical_atlas.tif"),
-            anatomical_stack_rs,
-            check_contrast=False,
-        )
+    geometry = _get_geometry(bg_atlas, pixel_size, section_size)
+    params = _build_params(bg_atlas, atlas_name, geometry)
+    manifest = _load_build_manifest(atlas_dir)
 
-    if args.force_download is True or _check_tiff_files() is False:
-        _save_rois_to_tiff(n_slices=n_slices, bg_atlas=bg_atlas)
+    if force is True:
+        shutil.rmtree(os.path.join(atlas_dir, CACHE_DIR), ignore_errors=True)
+        manifest = {"files": {}}
+    elif _is_shipped_geometry(atlas_name, geometry):
+        _adopt_shipped_files(atlas_dir, manifest, params)
+    else:
+        _drop_adopted_files(atlas_dir, manifest)
 
-    if args.force_download is True or _check_files() is False:
-        _assign_region_colors()
+    _save_metadata(atlas_dir, bg_atlas, atlas_name, geometry)
 
-    if args.force_download is True or _check_files() is False:
-        _save_roi_shapes(n_slices=n_slices)
+    stale = [i for i in params if not _is_current(atlas_dir, manifest, i, params[i])]
+    if atlas_bundle.BUNDLE_FILE not in stale and any(
+        i in stale for i in atlas_bundle.SOURCE_FILES
+    ):
+        stale.append(atlas_bundle.BUNDLE_FILE)
+    if len(stale) == 0:
+        print("All atlas files are up to date.")
+        return
+
+    print(f"Building {', '.join(stale)} in {atlas_dir}...")
+
+    builders = {
+        "anatomical_atlas.tif": lambda: _save_anatomical_atlas(
+            atlas_dir, bg_atlas, geometry
+        ),
+        "rois_atlas.tif": lambda: _save_rois_to_tiff(atlas_dir, bg_atlas, geometry),
+        "roi_colors.json": lambda: _assign_region_colors(atlas_dir),
+        "roi_shapes.json": lambda: _save_roi_shapes(
+            atlas_dir, bg_atlas, geometry, params["roi_shapes.json"]
+        ),
+        "slice_centroids.csv": lambda: _save_slice_centroids(
+            atlas_dir, bg_atlas, geometry
+        ),
+        atlas_bundle.BUNDLE_FILE: lambda: atlas_bundle.save_bundle(atlas_dir),
+    }
 
-    if args.force_download is True or _check_files() is False:
-        _save_slice_centroids(bg_atlas=bg_atlas, n_slices=n_slices)
+    for fname in stale:
+        builders[fname]()
+        _record_build(atlas_dir, manifest, fname, params[fname])
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--force-download", action="store_true")
+    parser.add_argument(
+        "--atlas",
+        type=str,
+        default=constants.DEFAULT_ATLAS,
+        help="BrainGlobe atlas name, e.g. allen_mouse_25um",
+    )
+    parser.add_argument(
+        "--pixel-size",
+        type=float,
+        default=SECTION_PIXEL_SIZE,
+        help="Pixel size of the preprocessed sections in um",
+    )
+    parser.add_argument(
+        "--section-size",
+        type=int,
+        default=SECTION_SIZE,
+        help="Side length of the preprocessed sections in pixels",
+    )
     args = parser.parse_args()
 
-    # configure atlas dir
-    if not os.path.isdir(ATLAS_PATH):
-        os.makedirs(ATLAS_PATH)
-
-    _prepare_atlas()
+    _prepare_atlas(
+        atlas_name=args.atlas,
+        pixel_size=args.pixel_size,
+        section_size=args.section_size,
+        force=args.force_download,
+    )
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported from src like in the scripts
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,47 @@
+import numpy as np
+
+from modules import alignment
+
+
+def _save(data_dir: str, polygons: list, analyzed: bool):
+    alignment.save_alignment(
+        data_dir,
+        "section_000.tif",
+        atlas_slice=42,
+        image_shift=(3, -5),
+        roi_names=["Striatum", "Cortex"][: len(polygons)],
+        roi_polygons=polygons,
+        background={"vertices": np.zeros((4, 2)), "mean": 12.5},
+        analyzed=analyzed,
+    )
+
+
+def test_saved_rois_are_added_again_after_reopening(tmp_path):
+    data_dir = str(tmp_path / "sections")
+    analyzed_polygons = [np.array([[0, 0], [0, 10], [10, 10]])]
+    draft_polygons = [
+        np.array([[1.5, 2], [3, 4], [5, 6.5], [1.5, 2]]),
+        np.array([[10, 10], [10, 20], [20, 20]]),
+    ]
+    _save(data_dir, analyzed_polygons, analyzed=True)
+    _save(data_dir, draft_polygons, analyzed=False)
+
+    # the section is opened again and the ROIs are added for the restored slice
+    section_alignment = alignment.load_alignment(
+        data_dir, "section_000.tif", draft=True
+    )
+    assert section_alignment["image_shift"] == (3, -5)
+    roi_names, roi_polygons = alignment.saved_rois(section_alignment, 42)
+    assert roi_names == ["Striatum", "Cortex"]
+    assert len(roi_polygons) == len(draft_polygons)
+    for polygon, expected in zip(roi_polygons, draft_polygons):
+        np.testing.assert_array_equal(polygon, expected)
+
+    # another slice gets the atlas polygons
+    assert alignment.saved_rois(section_alignment, 41) is None
+
+    # the draft does not replace the analyzed alignment
+    section_alignment = alignment.load_alignment(data_dir, "section_000.tif")
+    roi_names, roi_polygons = alignment.saved_rois(section_alignment, 42)
+    assert roi_names == ["Striatum"]
+    np.testing.assert_array_equal(roi_polygons[0], analyzed_polygons[0])
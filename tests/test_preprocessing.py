@@ -0,0 +1,154 @@
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.filters import median, threshold_otsu
+from skimage.morphology import binary_opening, remove_small_objects
+
+from modules import preprocessing
+
+
+def _synthetic_slide(seed: int = 0) -> np.ndarray:
+    # noisy background with tissue sections, one with a hole, one cut by the
+    # border, one below the size limit and isolated bright specks
+    rng = np.random.default_rng(seed)
+    img = rng.normal(1000, 150, (500, 900))
+
+    y, x = np.mgrid[:500, :900]
+    for cy, cx, ry, rx in [
+        (120, 150, 80, 110),
+        (330, 170, 90, 120),
+        (250, 460, 140, 100),
+        (60, 860, 90, 80),
+        (420, 700, 30, 40),
+    ]:
+        img[((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2 <= 1] += 2500
+    img[(y - 250) ** 2 + (x - 460) ** 2 <= 30**2] -= 2500
+    img[rng.integers(0, 500, 50), rng.integers(0, 900, 50)] = 20000
+
+    img += rng.normal(0, 300, img.shape)
+    return np.clip(img, 0, 65535).astype(np.uint16)
+
+
+def _full_resolution_mask(img: np.ndarray) -> np.ndarray:
+    # the original tissue mask of the preprocessing script
+    blurred = median(img, np.ones((11, 11)))
+    thresholded = blurred > threshold_otsu(blurred)
+    fill_holes = ndi.binary_fill_holes(thresholded)
+    fill_holes = binary_opening(fill_holes, np.ones((5, 5)))
+    return remove_small_objects(fill_holes, 6000)
+
+
+def test_tissue_mask_matches_full_resolution_mask():
+    for seed in range(3):
+        img = _synthetic_slide(seed)
+        expected = _full_resolution_mask(img)
+        assert expected.any()
+
+        np.testing.assert_array_equal(
+            preprocessing._tissue_mask(img, downsample=1), expected
+        )
+
+
+def test_downsampled_tissue_mask_keeps_section_bounding_boxes():
+    for seed in range(3):
+        img = _synthetic_slide(seed)
+        expected = preprocessing._separate_sections(
+            preprocessing._tissue_mask(img, downsample=1)
+        )
+        assert expected.max() > 1
+
+        for downsample in (preprocessing.MASK_DOWNSAMPLE, 2):
+            labels = preprocessing._separate_sections(
+                preprocessing._tissue_mask(img, downsample)
+            )
+            assert ndi.find_objects(labels) == ndi.find_objects(expected), (
+                seed,
+                downsample,
+            )
+
+
+def _disc_mask(shape: tuple, discs: list) -> np.ndarray:
+    y, x = np.mgrid[: shape[0], : shape[1]]
+    mask = np.zeros(shape, dtype=bool)
+    for cy, cx, r in discs:
+        mask |= (y - cy) ** 2 + (x - cx) ** 2 <= r**2
+
+    return mask
+
+
+def test_component_sections_match_watershed_sections():
+    shape = (1200, 1600)
+    rng = np.random.default_rng(0)
+    masks = {
+        # two overlapping sections in one component, and a section on its own
+        "touching": _disc_mask(
+            shape, [(400, 400, 220), (700, 750, 250), (600, 1300, 200)]
+        ),
+        # sections cut by the border or with their maximum near the border
+        "border": _disc_mask(
+            shape, [(0, 300, 260), (600, 1600, 300), (1100, 700, 180), (600, 700, 150)]
+        ),
+        # tiny fragments next to the sections and far from them
+        "fragments": _disc_mask(
+            shape,
+            [(500, 500, 250), (500, 790, 30), (800, 500, 12), (300, 1200, 5)]
+            + [(950, 1300, 3), (1000, 1000, 200)],
+        ),
+        "random": _disc_mask(
+            shape,
+            [
+                (y, x, r)
+                for y, x, r in zip(
+                    rng.integers(0, shape[0], 12),
+                    rng.integers(0, shape[1], 12),
+                    rng.integers(10, 260, 12),
+                )
+            ],
+        ),
+    }
+
+    for name, mask in masks.items():
+        expected = preprocessing._separate_sections(mask, "watershed")
+        labels = preprocessing._separate_sections(mask, "components")
+        assert expected.max() > 1, name
+
+        np.testing.assert_array_equal(labels, expected, err_msg=name)
+
+        # 16-bit labels of the low-memory mode
+        labels = preprocessing._separate_sections(mask, "components", np.uint16)
+        np.testing.assert_array_equal(labels, expected, err_msg=name)
+
+
+def _random_sections_mask(rng: np.random.Generator) -> np.ndarray:
+    # overlapping rectangles and ellipses, long rectangles get several seeds
+    # with flat distance transforms between them
+    shape = tuple(rng.integers(900, 1400, 2))
+    y, x = np.ogrid[: shape[0], : shape[1]]
+    mask = np.zeros(shape, dtype=bool)
+    for _ in range(rng.integers(2, 7)):
+        cy, cx = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        if rng.random() < 0.5:
+            ry, rx = rng.integers(50, 450, 2)
+            mask[max(cy - ry, 0) : cy + ry, max(cx - rx, 0) : cx + rx] = True
+        else:
+            ry, rx = rng.integers(50, 350, 2)
+            mask |= ((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2 <= 1
+
+    return mask
+
+
+def test_component_sections_match_watershed_sections_on_random_masks():
+    # the seeds are the same, only pixels on flat parts of the distance transform
+    # between two seeds may be given to the other section
+    for seed in range(12):
+        mask = _random_sections_mask(np.random.default_rng(seed))
+        expected = preprocessing._separate_sections(mask, "watershed")
+        labels = preprocessing._separate_sections(mask, "components")
+        assert labels.max() == expected.max(), seed
+
+        distance = ndi.distance_transform_edt(mask)
+        flat = np.zeros(mask.shape, dtype=bool)
+        flat[1:] |= distance[1:] == distance[:-1]
+        flat[:-1] |= distance[1:] == distance[:-1]
+        flat[:, 1:] |= distance[:, 1:] == distance[:, :-1]
+        flat[:, :-1] |= distance[:, 1:] == distance[:, :-1]
+        assert flat[labels != expected].all(), seed